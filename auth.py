@@ -1,26 +1,56 @@
+import json
 import os.path
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import pickle
+import threading
 
+from constants import CACHE_PATH, HTTP_TIMEOUT
 
-# If modifying these scopes, delete the file token.pickle.
+
+# Tokens missing any of these scopes are replaced by signing in again.
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive.file",
+    # Lets the local mirror read the gradecard's version, as drive.file only
+    # covers files this tool created or opened
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 
 
+# Credentials are shared by the whole process, while service objects and
+# their HTTP transports are pooled per thread since httplib2 is not
+# thread-safe
+cached_credentials = None
+credentials_lock = threading.Lock()
+local = threading.local()
+
+
 def get_credentials():
-    credentials = None
+    global cached_credentials
+
+    with credentials_lock:
+        if cached_credentials is None or not cached_credentials.valid:
+            cached_credentials = load_credentials(cached_credentials)
+        return cached_credentials
+
+
+def load_credentials(credentials=None):
+    # Google's auth libraries are slow to import, so only load them when
+    # a command actually talks to Google
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
 
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists("token.json"):
-        credentials = Credentials.from_authorized_user_file("token.json", SCOPES)
+    if credentials is None and os.path.exists("token.json"):
+        # Keep the scopes the token was granted, to tell whether it predates
+        # a scope added since
+        credentials = Credentials.from_authorized_user_file("token.json")
+        if not credentials.has_scopes(SCOPES):
+            print("[INFO] The saved login is missing permissions, signing in again")
+            credentials = None
 
     # If there are no (valid) credentials available, let the user log in.
     if not credentials or not credentials.valid:
@@ -36,28 +66,85 @@ def get_credentials():
     return credentials
 
 
+def get_discovery_document(service, version):
+    # Keep a pickled copy of the parsed discovery document so that building
+    # a service never fetches or parses it again
+    path = os.path.join(CACHE_PATH, "discovery", f"{service}.{version}.pickle")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    from googleapiclient import discovery, discovery_cache
+
+    document = discovery_cache.get_static_doc(service, version)
+    if document is None:
+        import httplib2
+
+        uri = discovery.V2_DISCOVERY_URI.format(api=service, apiVersion=version)
+        _, document = httplib2.Http().request(uri)
+    document = json.loads(document)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+    return document
+
+
+def build(service, version, http=None):
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(get_discovery_document(service, version), http=http)
+
+
+def get_pooled(key, factory):
+    pool = getattr(local, "pool", None)
+    if pool is None:
+        pool = local.pool = {}
+    if key not in pool:
+        pool[key] = factory()
+    return pool[key]
+
+
+def get_http():
+    # One keep-alive transport per thread, so that every call it makes
+    # reuses the same TCP/TLS connections to Google
+    def factory():
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+
+        return AuthorizedHttp(
+            get_credentials(), http=httplib2.Http(timeout=HTTP_TIMEOUT)
+        )
+
+    return get_pooled("http", factory)
+
+
 def get_service(service, version):
-    credentials = get_credentials()
-    service = build(service, version, credentials=credentials)
-    return service
+    return get_pooled(
+        (service, version), lambda: build(service, version, http=get_http())
+    )
 
 
 def get_sheet_service():
-    service = get_service("sheets", "v4")
-    sheet = service.spreadsheets()
-    return sheet
+    return get_pooled(
+        ("sheets", "v4", "spreadsheets"),
+        lambda: get_service("sheets", "v4").spreadsheets(),
+    )
 
 
 def get_drive_service():
-    service = get_service("drive", "v3")
-    drive = service.files()
-    return drive
+    return get_pooled(
+        ("drive", "v3", "files"), lambda: get_service("drive", "v3").files()
+    )
 
 
 def get_permissions_service():
-    service = get_service("drive", "v3")
-    permissions = service.permissions()
-    return permissions
+    return get_pooled(
+        ("drive", "v3", "permissions"),
+        lambda: get_service("drive", "v3").permissions(),
+    )
 
 
 if __name__ == "__main__":
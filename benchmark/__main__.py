@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import dataset
+from benchmark.fakes import FakeBackend, make_gradescope_module
+
+# The real gradescope package must never be reached from a benchmark
+sys.modules["gradescope"] = make_gradescope_module([], {})
+os.environ["GC_HEADLESS"] = "true"
+
+import auth
+import ratelimit
+import state
+from constants import (
+    CARD_SHEETS,
+    CARD_VIEWS,
+    EXPORT_HEADER,
+    EXPORT_SHEET_NAME,
+    ROSTER_SHEET_NAME,
+)
+from secrets import BASE_STUDENT_SPREADSHEET_ID, GRADECARD_SPREADSHEET_ID
+from service import GoogleCloudService, GradescopeService
+from util import get_column_letter
+
+NUM_ASSIGNMENTS = 12
+NUM_QUESTIONS = 6
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark gradecard actions against in-process fakes"
+    )
+    parser.add_argument("--students", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument(
+        "--latency", type=float, default=0.002, help="seconds per HTTP request"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="chance of a 429 per call"
+    )
+    parser.add_argument(
+        "--quota", action="store_true", help="pace calls at the real API quotas"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def install(backend, gradescope_module, args):
+    auth.build = backend.build
+    auth.get_http = lambda: None
+    auth.local = threading.local()
+    sys.modules["gradescope"] = gradescope_module
+    state.stores.clear()
+
+    if not args.quota:
+        for name in ratelimit.BUCKETS:
+            ratelimit.BUCKETS[name] = ratelimit.TokenBucket(10**9)
+        ratelimit.BACKOFF_BASE = 0.01
+
+
+def seed_gradecard(backend, num_students):
+    backend.add_spreadsheet(
+        GRADECARD_SPREADSHEET_ID, [ROSTER_SHEET_NAME, EXPORT_SHEET_NAME]
+    )
+    backend.add_spreadsheet(BASE_STUDENT_SPREADSHEET_ID, CARD_SHEETS)
+    backend.write(
+        f"{ROSTER_SHEET_NAME}!A2",
+        GRADECARD_SPREADSHEET_ID,
+        dataset.generate_roster(num_students),
+    )
+    backend.write(
+        f"{EXPORT_SHEET_NAME}!A1",
+        GRADECARD_SPREADSHEET_ID,
+        [dataset.generate_export_header(NUM_ASSIGNMENTS)],
+    )
+    for sheet in CARD_VIEWS:
+        backend.write(
+            f"{sheet}!A1",
+            BASE_STUDENT_SPREADSHEET_ID,
+            [[f"=Data!B{i}" for i in range(1, 40)]],
+        )
+
+
+def fill_export_variables(backend):
+    # Stand-in for the formulas that fill the export sheet after card creation
+    header = backend.read(f"{EXPORT_SHEET_NAME}!1:1", GRADECARD_SPREADSHEET_ID)[0]
+    rows = backend.read(f"{EXPORT_SHEET_NAME}!A3:A", GRADECARD_SPREADSHEET_ID)
+    column = get_column_letter(len(EXPORT_HEADER))
+    backend.write(
+        f"{EXPORT_SHEET_NAME}!{column}3",
+        GRADECARD_SPREADSHEET_ID,
+        dataset.generate_export_variables(header, rows),
+    )
+
+
+def measure(name, num_students, action, backend, gradescope_calls):
+    backend.reset_counters()
+    gradescope_calls.clear()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        action()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = Counter(backend.calls)
+    calls.update(gradescope_calls)
+    http = calls.pop("http", 0) + sum(gradescope_calls.values())
+    errors = calls.pop("errors", 0)
+    calls.pop("batch", None)
+    api_calls = sum(calls.values())
+
+    return {
+        "students": num_students,
+        "action": name,
+        "wall_seconds": round(wall, 3),
+        "api_calls": api_calls,
+        "http_requests": http,
+        "api_calls_per_student": round(api_calls / num_students, 2),
+        "rate_limit_errors": errors,
+        "peak_memory_mb": round(peak / 2**20, 2),
+        "calls": dict(calls),
+    }
+
+
+def run_scenario(num_students, args):
+    # Each scenario keeps its config, state and cache in a fresh directory
+    os.makedirs("config")
+    with open(os.path.join("config", "bench.ini"), "w") as f:
+        f.write(dataset.generate_config(NUM_QUESTIONS))
+
+    backend = FakeBackend(latency=args.latency, error_rate=args.error_rate)
+    gradescope_calls = Counter()
+    gradescope_module = make_gradescope_module(
+        [
+            {"id": 1, "name": "Homework Bench", "published": True},
+            {"id": 2, "name": "Check Your Understanding Bench", "published": True},
+        ],
+        {
+            1: dataset.generate_evaluations(num_students, NUM_QUESTIONS),
+            2: dataset.generate_cyu_evaluations(num_students),
+        },
+        latency=args.latency * 50,
+        calls=gradescope_calls,
+    )
+    install(backend, gradescope_module, args)
+    seed_gradecard(backend, num_students)
+
+    service = GoogleCloudService()
+    results = []
+
+    def run(name, action):
+        result = measure(name, num_students, action, backend, gradescope_calls)
+        results.append(result)
+        print_result(result)
+
+    run("create_cards", lambda: service.create_cards(["student"]))
+    fill_export_variables(backend)
+    run("update_views", lambda: service.update_views(CARD_VIEWS, ["student"]))
+    run("sync_data", lambda: service.sync_data(["student"]))
+    run(
+        "load_data_from_config",
+        lambda: GradescopeService().load_data_from_config("bench.ini"),
+    )
+
+    return results
+
+
+def print_result(result):
+    print(
+        f"{result['students']:>8} {result['action']:<22} "
+        f"{result['wall_seconds']:>9.3f} {result['api_calls']:>9} "
+        f"{result['http_requests']:>9} {result['api_calls_per_student']:>9.2f} "
+        f"{result['rate_limit_errors']:>7} {result['peak_memory_mb']:>9.2f}"
+    )
+
+
+def main():
+    args = parse_args()
+    cwd = os.getcwd()
+
+    print(
+        f"{'students':>8} {'action':<22} {'wall (s)':>9} {'calls':>9} "
+        f"{'http':>9} {'calls/stu':>9} {'429s':>7} {'peak MB':>9}"
+    )
+    results = []
+    for num_students in args.students:
+        with tempfile.TemporaryDirectory(prefix="gradecard-bench-") as workdir:
+            os.chdir(workdir)
+            try:
+                results.extend(run_scenario(num_students, args))
+            finally:
+                os.chdir(cwd)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
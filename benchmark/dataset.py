@@ -0,0 +1,131 @@
+import random
+
+from constants import ROSTER_HEADER, EXPORT_HEADER
+
+SECTIONS = "ABCDEFGHJKLM"
+GRADE_OPTIONS = ["L", "P", "A"]
+GRADERS = ["AB", "CD", "EF", "GH", "IJ", "KL"]
+
+
+def get_andrew_id(i):
+    return f"stu{i:05d}"
+
+
+def generate_roster(num_students, seed=0):
+    rng = random.Random(seed)
+    roster = []
+
+    for i in range(num_students):
+        andrew_id = get_andrew_id(i)
+        row = ["" for _ in ROSTER_HEADER]
+        fields = {
+            "Semester": "S23",
+            "Course": "15251",
+            "Section": rng.choice(SECTIONS),
+            "Lecture": "1",
+            "Last Name": f"Last{i}",
+            "Preferred/First Name": f"First{i}",
+            "Andrew ID": andrew_id,
+            "Email": f"{andrew_id}@andrew.cmu.edu",
+            "College": "SCS",
+            "Class": str(rng.randint(1, 4)),
+            "Units": "12.0",
+            "Grade Option": rng.choice(GRADE_OPTIONS),
+        }
+        for column, value in fields.items():
+            row[ROSTER_HEADER.index(column)] = value
+        roster.append(row)
+
+    return roster
+
+
+def generate_export_header(num_assignments):
+    # Public variables, one private variable, then columns that are never synced
+    variables = list(EXPORT_HEADER)
+    for i in range(1, 1 + num_assignments):
+        variables.extend([f"hw{i}", f"hw{i}_late", f"cyu{i}"])
+    variables.extend(["_notes", "total", "STOP", "scratch"])
+    return variables
+
+
+def generate_export_variables(header, andrew_ids, seed=0):
+    # Values for every column after the card IDs, one row per student
+    rng = random.Random(seed)
+    rows = []
+    for _ in andrew_ids:
+        rows.append(
+            [
+                f"{rng.random() * 100:.2f}" if column != "_notes" else "ok"
+                for column in header[len(EXPORT_HEADER) :]
+            ]
+        )
+    return rows
+
+
+def generate_config(num_questions):
+    lines = [
+        "[overview]",
+        "name = Homework Bench",
+        "gsheet_name = hwbench",
+        "cyu = Check Your Understanding Bench",
+        f"num_questions = {num_questions}",
+        "",
+    ]
+    for i in range(1, 1 + num_questions):
+        lines.extend([f"[question{i}]", f"name = Problem {i}"])
+        if i % 3 == 0:
+            lines.append(f"star_name = Star Problem {i}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_question_names(num_questions):
+    names = []
+    for i in range(1, 1 + num_questions):
+        names.append(f"{i}: Problem {i} (10.0 pts)")
+        if i % 3 == 0:
+            names.append(f"{i}.S: Star Problem {i} (10.0 pts)")
+    return names
+
+
+def generate_evaluations(num_students, num_questions, seed=0, rubric_items=8):
+    rng = random.Random(seed)
+    question_names = generate_question_names(num_questions)
+    evaluations = []
+
+    for i in range(num_students):
+        questions = {}
+        for name in question_names:
+            rubric = {f"Grader ({grader})": False for grader in GRADERS}
+            rubric[f"Grader ({rng.choice(GRADERS)})"] = True
+            for j in range(rubric_items):
+                rubric[f"Rubric item {j}"] = rng.random() < 0.3
+            questions[name] = {
+                "score": rng.choice([0, 2.5, 5, 7.5, 10]),
+                "comment": rng.choice(["", "Nice work", "See the posted solution"]),
+                "rubric_items": rubric,
+            }
+
+        evaluations.append(
+            {
+                "Email": f"{get_andrew_id(i)}@andrew.cmu.edu",
+                "Status": "Graded" if rng.random() < 0.95 else "Missing",
+                "Submission Time": "2023-02-01 12:00:00 -0500",
+                "Total Score": rng.random() * 10,
+                "questions": questions,
+            }
+        )
+
+    return evaluations
+
+
+def generate_cyu_evaluations(num_students, seed=0):
+    rng = random.Random(seed)
+    return [
+        {
+            "Email": f"{get_andrew_id(i)}@andrew.cmu.edu",
+            "Status": "Graded",
+            "Total Score": rng.random() * 5,
+        }
+        for i in range(num_students)
+    ]
@@ -0,0 +1,391 @@
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+import types
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from util import parse_range
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({"status": status}), b"{}")
+
+
+class FakeRequest:
+    def __init__(self, backend, method_id, handler, kwargs):
+        self.backend = backend
+        self.methodId = method_id
+        self.handler = handler
+        self.kwargs = kwargs
+        self.body = json.dumps(kwargs["body"]) if "body" in kwargs else None
+
+    def execute(self, http=None, num_retries=0):
+        self.backend.round_trip()
+        return self.backend.call(self)
+
+
+class FakeBatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self, http=None):
+        self.backend.round_trip()
+        self.backend.count("batch")
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = self.backend.call(request), None
+            except HttpError as e:
+                response, exception = None, e
+            callback(request_id, response, exception)
+
+
+class FakeResource:
+    def __init__(self, backend, prefix, methods, resources=()):
+        self.backend = backend
+        self.prefix = prefix
+        self.methods = methods
+        self.resources = resources
+
+    def __getattr__(self, name):
+        if name in self.resources:
+            return lambda: self.resources[name]
+        if name in self.methods:
+            handler = self.methods[name]
+            return lambda **kwargs: FakeRequest(
+                self.backend, f"{self.prefix}.{name}", handler, kwargs
+            )
+        raise AttributeError(name)
+
+
+class FakeBackend:
+    # In-process stand-in for Sheets and Drive, with simulated latency and
+    # rate-limit errors
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.spreadsheets = {}
+        self.parents = {}
+        self.permissions = Counter()
+        self.versions = Counter()
+        self.calls = Counter()
+        self.ids = itertools.count(1)
+
+    def round_trip(self):
+        self.count("http")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, method_id):
+        with self.lock:
+            self.calls[method_id] += 1
+
+    def call(self, request):
+        with self.lock:
+            self.calls[request.methodId] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.calls["errors"] += 1
+                raise http_error(429)
+            return request.handler(**request.kwargs)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+
+    def build(self, service, version, **kwargs):
+        if service == "sheets":
+            values = FakeResource(
+                self,
+                "sheets.spreadsheets.values",
+                {
+                    "get": self.values_get,
+                    "batchGet": self.values_batch_get,
+                    "update": self.values_update,
+                    "batchUpdate": self.values_batch_update,
+                    "clear": self.values_clear,
+                    "append": self.values_append,
+                },
+            )
+            sheets = FakeResource(
+                self, "sheets.spreadsheets.sheets", {"copyTo": self.sheets_copy_to}
+            )
+            spreadsheets = FakeResource(
+                self,
+                "sheets.spreadsheets",
+                {
+                    "create": self.spreadsheets_create,
+                    "get": self.spreadsheets_get,
+                    "batchUpdate": self.spreadsheets_batch_update,
+                },
+                {"values": values, "sheets": sheets},
+            )
+            root = FakeResource(self, "sheets", {}, {"spreadsheets": spreadsheets})
+            root.new_batch_http_request = lambda callback=None: FakeBatch(
+                self, callback
+            )
+            return root
+
+        files = FakeResource(
+            self, "drive.files", {"get": self.files_get, "update": self.files_update}
+        )
+        permissions = FakeResource(
+            self, "drive.permissions", {"create": self.permissions_create}
+        )
+        return FakeResource(
+            self, "drive", {}, {"files": files, "permissions": permissions}
+        )
+
+    # Spreadsheet storage
+    def add_spreadsheet(self, spreadsheet_id, sheet_names, title=""):
+        self.spreadsheets[spreadsheet_id] = {
+            "title": title,
+            "sheets": {
+                name: {"id": next(self.ids), "values": []} for name in sheet_names
+            },
+        }
+        self.parents[spreadsheet_id] = ["root"]
+
+    def get_sheet(self, spreadsheet_id, sheet_name):
+        try:
+            return self.spreadsheets[spreadsheet_id]["sheets"][sheet_name]
+        except KeyError:
+            raise http_error(400) from None
+
+    def read(self, sheet_range, spreadsheet_id):
+        sheet, first_row, first_column, last_row, last_column = parse_range(sheet_range)
+        values = self.get_sheet(spreadsheet_id, sheet)["values"]
+        rows = values[first_row : None if last_row is None else last_row + 1]
+        stop = None if last_column is None else last_column + 1
+        rows = [list(row[first_column:stop]) for row in rows]
+
+        # Like Sheets, drop trailing empty cells and rows
+        for row in rows:
+            while row and row[-1] == "":
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def write(self, sheet_range, spreadsheet_id, values):
+        sheet, first_row, first_column, _, _ = parse_range(sheet_range)
+        grid = self.get_sheet(spreadsheet_id, sheet)["values"]
+        self.versions[spreadsheet_id] += 1
+        for i, row in enumerate(values):
+            while len(grid) <= first_row + i:
+                grid.append([])
+            target = grid[first_row + i]
+            while len(target) < first_column + len(row):
+                target.append("")
+            for j, value in enumerate(row):
+                target[first_column + j] = "" if value is None else str(value)
+
+    def clear(self, sheet_range, spreadsheet_id):
+        sheet, first_row, first_column, last_row, last_column = parse_range(sheet_range)
+        grid = self.get_sheet(spreadsheet_id, sheet)["values"]
+        self.versions[spreadsheet_id] += 1
+        for row in grid[first_row : None if last_row is None else last_row + 1]:
+            stop = len(row) if last_column is None else min(len(row), last_column + 1)
+            for j in range(first_column, stop):
+                row[j] = ""
+
+    # Sheets values API
+    def values_get(self, spreadsheetId, range, **kwargs):
+        rows = self.read(range, spreadsheetId)
+        return {"range": range, "values": rows} if rows else {"range": range}
+
+    def values_batch_get(self, spreadsheetId, ranges, **kwargs):
+        return {
+            "valueRanges": [
+                self.values_get(spreadsheetId, sheet_range) for sheet_range in ranges
+            ]
+        }
+
+    def values_update(self, spreadsheetId, range, body, **kwargs):
+        self.write(range, spreadsheetId, body.get("values", []))
+        return {"updatedRange": range}
+
+    def values_batch_update(self, spreadsheetId, body):
+        for value_range in body["data"]:
+            self.write(value_range["range"], spreadsheetId, value_range["values"])
+        return {"totalUpdatedCells": 0}
+
+    def values_clear(self, spreadsheetId, range):
+        self.clear(range, spreadsheetId)
+        return {"clearedRange": range}
+
+    def values_append(self, spreadsheetId, range, body, **kwargs):
+        sheet = parse_range(range)[0]
+        grid = self.get_sheet(spreadsheetId, sheet)["values"]
+        end = len(grid)
+        while end and not any(grid[end - 1]):
+            end -= 1
+        self.write(f"{sheet}!A{end + 1}", spreadsheetId, body["values"])
+        return {"updates": {"updatedRows": len(body["values"])}}
+
+    # Sheets spreadsheets API
+    def spreadsheets_create(self, body):
+        spreadsheet_id = f"fake-{next(self.ids)}"
+        self.add_spreadsheet(
+            spreadsheet_id,
+            [sheet["properties"]["title"] for sheet in body.get("sheets", [])],
+            body["properties"]["title"],
+        )
+        return {"spreadsheetId": spreadsheet_id}
+
+    def spreadsheets_get(self, spreadsheetId, fields=None, **kwargs):
+        if spreadsheetId not in self.spreadsheets:
+            raise http_error(404)
+
+        sheets = []
+        for index, (title, sheet) in enumerate(
+            self.spreadsheets[spreadsheetId]["sheets"].items()
+        ):
+            sheets.append(
+                {
+                    "properties": {
+                        "sheetId": sheet["id"],
+                        "title": title,
+                        "index": index,
+                        "gridProperties": {
+                            "rowCount": max(1000, len(sheet["values"])),
+                            "columnCount": max(
+                                [26] + [len(row) for row in sheet["values"]]
+                            ),
+                        },
+                    }
+                }
+            )
+        return {"spreadsheetId": spreadsheetId, "sheets": sheets}
+
+    def spreadsheets_batch_update(self, spreadsheetId, body):
+        # Requests apply all together or not at all, like the real API
+        if spreadsheetId not in self.spreadsheets:
+            raise http_error(404)
+        sheets = copy.deepcopy(self.spreadsheets[spreadsheetId]["sheets"])
+        by_id = lambda sheet_id: next(
+            (title for title, sheet in sheets.items() if sheet["id"] == sheet_id),
+            None,
+        )
+
+        replies = []
+        for request in body["requests"]:
+            replies.append({})
+            if "addSheet" in request:
+                title = request["addSheet"]["properties"]["title"]
+                if title in sheets:
+                    raise http_error(400)
+                sheets[title] = {"id": next(self.ids), "values": []}
+                replies[-1] = {
+                    "addSheet": {
+                        "properties": {"sheetId": sheets[title]["id"], "title": title}
+                    }
+                }
+            elif "deleteSheet" in request:
+                title = by_id(request["deleteSheet"]["sheetId"])
+                if title is None:
+                    raise http_error(400)
+                del sheets[title]
+            elif "updateSheetProperties" in request:
+                properties = request["updateSheetProperties"]["properties"]
+                title = by_id(properties["sheetId"])
+                if title is None:
+                    raise http_error(400)
+                items = list(sheets.items())
+                index = [name for name, _ in items].index(title)
+                sheet = items.pop(index)[1]
+                items.insert(
+                    properties.get("index", index),
+                    (properties.get("title", title), sheet),
+                )
+                sheets = dict(items)
+            elif "copyPaste" in request:
+                source = by_id(request["copyPaste"]["source"]["sheetId"])
+                destination = by_id(request["copyPaste"]["destination"]["sheetId"])
+                if source is None or destination is None:
+                    raise http_error(400)
+                sheets[destination]["values"] = copy.deepcopy(sheets[source]["values"])
+            elif "updateCells" in request:
+                title = by_id(request["updateCells"]["range"]["sheetId"])
+                if title is None:
+                    raise http_error(400)
+                sheets[title]["values"] = []
+
+        self.spreadsheets[spreadsheetId]["sheets"] = sheets
+        self.versions[spreadsheetId] += 1
+        return {"replies": replies}
+
+    def sheets_copy_to(self, spreadsheetId, sheetId, body):
+        source = self.spreadsheets[spreadsheetId]["sheets"]
+        title = next(title for title, sheet in source.items() if sheet["id"] == sheetId)
+        destination = self.spreadsheets[body["destination_spreadsheet_id"]]["sheets"]
+
+        name, suffix = f"Copy of {title}", 2
+        while name in destination:
+            name, suffix = f"Copy of {title} {suffix}", suffix + 1
+
+        new_sheet_id = next(self.ids)
+        self.versions[body["destination_spreadsheet_id"]] += 1
+        destination[name] = {
+            "id": new_sheet_id,
+            "values": copy.deepcopy(source[title]["values"]),
+        }
+        return {"sheetId": new_sheet_id, "title": name}
+
+    # Drive API
+    def files_get(self, fileId, fields=None, **kwargs):
+        if fileId not in self.parents:
+            raise http_error(404)
+        # Drive reports versions as strings
+        return {
+            "id": fileId,
+            "parents": list(self.parents[fileId]),
+            "version": str(self.versions[fileId]),
+        }
+
+    def files_update(self, fileId, addParents=None, removeParents=None, **kwargs):
+        parents = [
+            parent
+            for parent in self.parents[fileId]
+            if parent not in (removeParents or "").split(",")
+        ]
+        if addParents:
+            parents.extend(addParents.split(","))
+        self.parents[fileId] = parents
+        return {"id": fileId, "parents": parents}
+
+    def permissions_create(self, fileId, body, **kwargs):
+        self.permissions[fileId] += 1
+        return {"id": str(next(self.ids))}
+
+
+def make_gradescope_module(assignments, evaluations, latency=0.0, calls=None):
+    # Stand-in for the gradescope package, serving a synthetic course
+    calls = Counter() if calls is None else calls
+    module = types.ModuleType("gradescope")
+
+    def get_course_assignments(course_id):
+        calls["gradescope.get_course_assignments"] += 1
+        time.sleep(latency)
+        return copy.deepcopy(assignments)
+
+    def get_assignment_evaluations(course_id, assignment_id):
+        calls["gradescope.get_assignment_evaluations"] += 1
+        time.sleep(latency)
+        return copy.deepcopy(evaluations[assignment_id])
+
+    module.get_course_assignments = get_course_assignments
+    module.get_assignment_evaluations = get_assignment_evaluations
+    module.calls = calls
+    return module
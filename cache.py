@@ -0,0 +1,131 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from constants import (
+    CACHE_PATH,
+    GRADESCOPE_CATALOG_TTL,
+    GRADESCOPE_EVALUATIONS_TTL,
+    GRADESCOPE_FINAL_AFTER,
+)
+
+
+class GradescopeCache:
+    def __init__(self, course_id):
+        self.path = os.path.join(CACHE_PATH, "gradescope", str(course_id))
+
+    def __read(self, name):
+        # Entries are gzipped JSON lines: a metadata line, then one line per item
+        try:
+            with gzip.open(os.path.join(self.path, name), "rt") as f:
+                meta = json.loads(f.readline())
+                items = [json.loads(line) for line in f]
+        except (FileNotFoundError, EOFError, OSError, json.JSONDecodeError):
+            return None, None
+
+        return meta, items
+
+    def __read_meta(self, name):
+        try:
+            with gzip.open(os.path.join(self.path, name), "rt") as f:
+                return json.loads(f.readline())
+        except (FileNotFoundError, EOFError, OSError, json.JSONDecodeError):
+            return None
+
+    def __iter_items(self, name):
+        # Yield one item at a time so that a large entry is never held in
+        # memory all at once
+        with gzip.open(os.path.join(self.path, name), "rt") as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    def __write(self, name, meta, items):
+        os.makedirs(self.path, exist_ok=True)
+        # Concurrent fetch workers may write the same entry, so each writes a
+        # temporary file of its own before moving it into place
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=f"{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+                f.write(json.dumps(meta) + "\n")
+                for item in items:
+                    f.write(json.dumps(item, separators=(",", ":")) + "\n")
+            os.replace(tmp_path, os.path.join(self.path, name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def get_assignments(self, fetch):
+        meta, assignments = self.__read("assignments.jsonl.gz")
+        if (
+            meta is not None
+            and time.time() - meta["fetched_at"] < GRADESCOPE_CATALOG_TTL
+        ):
+            return assignments
+
+        assignments = fetch()
+        self.__write("assignments.jsonl.gz", {"fetched_at": time.time()}, assignments)
+        return assignments
+
+    def get_assignments_meta(self):
+        return self.__read_meta("assignments.jsonl.gz")
+
+    def get_evaluations(self, assignment, fetch):
+        name = f"{assignment['id']}.jsonl.gz"
+        meta = self.__read_meta(name)
+        current = time.time()
+
+        if meta is not None:
+            # Published assignments that have been fully graded for a while
+            # are not going to change again
+            final_since = meta.get("final_since")
+            if (
+                final_since is not None
+                and current - final_since >= GRADESCOPE_FINAL_AFTER
+            ):
+                return self.__iter_items(name)
+            if current - meta["fetched_at"] < GRADESCOPE_EVALUATIONS_TTL:
+                return self.__iter_items(name)
+
+        evaluations = fetch()
+
+        # Missing submissions never get graded, so only ungraded ones keep an
+        # assignment from being final
+        final = assignment["published"] and not any(
+            evaluation["Status"] == "Ungraded" for evaluation in evaluations
+        )
+        if not final:
+            final_since = None
+        elif meta is not None and meta.get("final_since") is not None:
+            final_since = meta["final_since"]
+        else:
+            final_since = current
+
+        self.__write(
+            name, {"fetched_at": current, "final_since": final_since}, evaluations
+        )
+
+        # Read the fresh entry back as a stream, letting the fetched export
+        # be freed as soon as this returns
+        del evaluations
+        return self.__iter_items(name)
+
+    def get_evaluations_meta(self, assignment):
+        return self.__read_meta(f"{assignment['id']}.jsonl.gz")
+
+    def invalidate(self, assignment_ids=None):
+        if assignment_ids is None:
+            names = os.listdir(self.path) if os.path.isdir(self.path) else []
+        else:
+            names = ["assignments.jsonl.gz"]
+            names.extend(
+                f"{assignment_id}.jsonl.gz" for assignment_id in assignment_ids
+            )
+
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
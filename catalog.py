@@ -0,0 +1,180 @@
+import configparser
+import os
+import pickle
+from collections import namedtuple
+
+from constants import CACHE_PATH, CONFIG_PATH
+
+# A config compiled once into everything a load needs. Slots are None for
+# questions the config leaves out
+ConfigPlan = namedtuple(
+    "ConfigPlan",
+    [
+        "file",
+        "name",
+        "cyu",
+        "num_questions",
+        "gsheet_name",
+        "questions",
+        "question_prefixes",
+        "columns",
+        "sort_key",
+        "poll_interval",
+    ],
+)
+QuestionSlot = namedtuple("QuestionSlot", ["name", "star_name"])
+
+
+def get_sort_key(name):
+    # Sort "Homework 2" before "Homework 10", and never compare ints to strings
+    return tuple((0, int(s), "") if s.isdigit() else (1, 0, s) for s in name.split(" "))
+
+
+def get_upload_columns(num_questions):
+    columns = ["Andrew ID", "Submission Time", "CYU Quiz Score"]
+    for i in range(1, 1 + num_questions):
+        columns.extend(
+            [
+                f"Problem {i} Score",
+                f"Problem {i} TA",
+                f"Problem {i} Name",
+                f"Problem {i} ⭐",
+                f"Problem {i} Comments",
+            ]
+        )
+
+    return tuple(columns)
+
+
+def compile_config(config_file, config_dict):
+    try:
+        num_questions = config_dict.getint("overview", "num_questions", fallback=0)
+
+        questions = []
+        for i in range(1, 1 + num_questions):
+            question = f"question{i}"
+            if question in config_dict:
+                questions.append(
+                    QuestionSlot(
+                        config_dict[question]["name"],
+                        config_dict[question].get("star_name", None),
+                    )
+                )
+            else:
+                questions.append(None)
+
+        # Every Gradescope question prefix the slots refer to, in the order
+        # they are first resolved
+        question_prefixes = []
+        for slot in filter(None, questions):
+            for prefix in (slot.name, slot.star_name):
+                if prefix and prefix not in question_prefixes:
+                    question_prefixes.append(prefix)
+
+        name = config_dict["overview"]["name"]
+        return ConfigPlan(
+            file=config_file,
+            name=name,
+            cyu=config_dict["overview"]["cyu"],
+            num_questions=num_questions,
+            gsheet_name=config_dict["overview"]["gsheet_name"],
+            questions=tuple(questions),
+            question_prefixes=tuple(question_prefixes),
+            columns=get_upload_columns(num_questions),
+            sort_key=get_sort_key(name),
+            poll_interval=config_dict.getint(
+                "overview", "poll_interval", fallback=None
+            ),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+class ConfigCatalog:
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        self.cache_path = os.path.join(CACHE_PATH, "config", "catalog.pickle")
+        self.entries = None
+        self.dirty = False
+
+    def __load(self):
+        # Entries map a config file to (mtime, size, name, plan). The name is
+        # kept even when the rest of the file is malformed
+        if self.entries is not None:
+            return
+
+        try:
+            with open(self.cache_path, "rb") as f:
+                self.entries = pickle.load(f)
+        except (
+            OSError,
+            EOFError,
+            pickle.UnpicklingError,
+            AttributeError,
+            TypeError,
+        ):
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        with open(f"{self.cache_path}.tmp", "wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.cache_path}.tmp", self.cache_path)
+        self.dirty = False
+
+    def __get_entry(self, config_file):
+        self.__load()
+
+        try:
+            stat = os.stat(os.path.join(self.path, config_file))
+        except FileNotFoundError:
+            return None, None
+
+        entry = self.entries.get(config_file)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[2:]
+
+        config_dict = configparser.ConfigParser()
+        config_dict.read(os.path.join(self.path, config_file))
+        try:
+            name = config_dict["overview"]["name"]
+        except KeyError:
+            name = None
+        plan = compile_config(config_file, config_dict)
+
+        self.entries[config_file] = (stat.st_mtime_ns, stat.st_size, name, plan)
+        self.dirty = True
+        return name, plan
+
+    def get_configs(self):
+        try:
+            config_files = [i for i in os.listdir(self.path) if i.endswith(".ini")]
+        except FileNotFoundError:
+            return []
+
+        self.__load()
+        for config_file in set(self.entries) - set(config_files):
+            del self.entries[config_file]
+            self.dirty = True
+
+        configs = []
+        for config_file in config_files:
+            name, _ = self.__get_entry(config_file)
+            if name is not None:
+                configs.append({"name": name, "value": config_file})
+        self.save()
+
+        configs.sort(key=lambda config: get_sort_key(config["name"]))
+        return configs
+
+    def get_plan(self, config_file):
+        _, plan = self.__get_entry(config_file)
+        self.save()
+
+        if plan is None:
+            raise ValueError("Malformed Configuration")
+
+        return plan
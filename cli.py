@@ -1,10 +1,30 @@
-from PyInquirer import prompt
+import argparse
 import glob
 import os
 
 from constants import MAP_ACTION_TO_ATTRIBUTE, CARD_VIEWS, ROSTER_PATH
 
 
+def prompt(questions):
+    # PyInquirer is slow to import and never needed by headless runs
+    from PyInquirer import prompt as inquirer_prompt
+
+    return inquirer_prompt(questions)
+
+
+def get_command(action):
+    return action.lower().replace(" ", "-")
+
+
+def parse_students(students):
+    if len(students) == 0:
+        return None, None
+    elif students.endswith("..."):
+        return None, students[:-3]
+    else:
+        return [student.strip() for student in students.split(",")], None
+
+
 def prompt_action():
     questions = [
         {
@@ -24,7 +44,11 @@ def prompt_roster():
             "type": "list",
             "name": "file",
             "message": "Which roster do you want to sync?",
-            "choices": glob.glob("*.csv") + glob.glob(f"{ROSTER_PATH}/*.csv"),
+            "choices": [
+                path
+                for pattern in ("*.csv", "*.csv.gz")
+                for path in glob.glob(pattern) + glob.glob(f"{ROSTER_PATH}/{pattern}")
+            ],
         },
     ]
     answers = prompt(questions)
@@ -69,20 +93,28 @@ def prompt_students():
         }
     ]
     answers = prompt(questions)
-    if len(answers["students"]) == 0:
-        return None, None
-    elif answers["students"].endswith("..."):
-        return None, answers["students"][:-3]
-    else:
-        return [student.strip() for student in answers["students"].split(",")], None
+    return parse_students(answers["students"])
 
 
-def prompt_configs(configs):
+def prompt_resume(num_done):
+    questions = [
+        {
+            "type": "confirm",
+            "name": "resume",
+            "message": f"The last run was interrupted after {num_done} students. Resume it?",
+            "default": True,
+        }
+    ]
+    answers = prompt(questions)
+    return answers["resume"]
+
+
+def prompt_configs(configs, message="Which assignments to pull grade data for?"):
     questions = [
         {
             "type": "checkbox",
             "name": "configs",
-            "message": "Which assignments to pull grade data for?",
+            "message": message,
             "choices": configs,
         }
     ]
@@ -104,3 +136,65 @@ def prompt_confirm_unpublished(assignment):
     ]
     answers = prompt(questions)
     return answers["pull"]
+
+
+def parse_args(args=None):
+    # Every action can also be run without prompts, e.g.
+    # ./main.py sync-data --students "abc..."
+    parser = argparse.ArgumentParser(description="Manage 15-251 gradecards")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    commands = {}
+
+    for action in MAP_ACTION_TO_ATTRIBUTE:
+        command = get_command(action)
+        commands[command] = action
+        subparser = subparsers.add_parser(command, help=action)
+        subparser.add_argument(
+            "--plan",
+            action="store_true",
+            help="print the API calls this would make, without making them",
+        )
+        _, attribute = MAP_ACTION_TO_ATTRIBUTE[action]
+
+        if attribute == "post_add_new_students":
+            subparser.add_argument("roster", help="path to the CSV roster (or .csv.gz)")
+        if attribute == "post_update_card_views":
+            subparser.add_argument(
+                "--views",
+                nargs="+",
+                choices=CARD_VIEWS,
+                default=CARD_VIEWS,
+                help="sheet views to update (default: all)",
+            )
+        if attribute in ("post_update_card_views", "post_update_card_data"):
+            subparser.add_argument(
+                "--students",
+                default="",
+                type=parse_students,
+                help='comma separated Andrew IDs, or "abc..." to start at one',
+            )
+            subparser.add_argument(
+                "--resume",
+                action="store_true",
+                help="skip students finished by the last, interrupted run",
+            )
+        if attribute == "post_update_card_data":
+            subparser.add_argument(
+                "--full",
+                action="store_true",
+                help="rewrite every card, even those unchanged since the last sync",
+            )
+        if attribute in ("post_load_data", "post_clear_cache"):
+            subparser.add_argument(
+                "--configs",
+                nargs="+",
+                default=None,
+                help="config files to use (default: all)",
+            )
+        if attribute == "post_load_data":
+            subparser.set_defaults(load_all_data=True)
+        if attribute == "post_clear_cache":
+            subparser.set_defaults(clear_all=True)
+
+    parsed = vars(parser.parse_args(args))
+    return commands[parsed.pop("command")], parsed
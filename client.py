@@ -1,55 +1,297 @@
-import gradescope
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import re
+import threading
+from googleapiclient.errors import HttpError
+from time import sleep
 
 from constants import (
     USER_ENTERED,
     CARD_SHEETS,
     CARD_SHEETS_TO_DELETE,
+    BATCH_SIZE,
+    VALUE_RANGES_PER_REQUEST,
+    UPLOAD_WORKERS,
+    UPLOAD_CHUNK_BYTES,
+    STAGING_SHEET_SUFFIX,
+    MAX_ATTEMPTS,
 )
+from cache import GradescopeCache
+from metrics import METRICS, get_payload_bytes, get_resource, track
+from ratelimit import BUCKETS, execute, is_retryable, get_backoff
+from state import get_state_store
+from util import chunked, chunk_rows, get_extent, pad_values
 from secrets import GRADESCOPE_COURSE_ID
-from auth import get_sheet_service, get_drive_service, get_permissions_service
+from auth import (
+    get_service,
+    get_sheet_service,
+    get_drive_service,
+    get_permissions_service,
+)
+
+STRAY_COPY_PATTERN = re.compile(
+    "|".join(rf"{re.escape(sheet)}(?: \d+)?" for sheet in CARD_SHEETS_TO_DELETE)
+)
 
 
 class GoogleCloudClient:
     def __init__(self):
-        self.sheet = get_sheet_service()
-        self.drive = get_drive_service()
-        self.permissions = get_permissions_service()
+        self.sheet_id_cache = {}
+        self.card_layouts = get_state_store("card_layouts")
+        self.sheet_extents = get_state_store("sheet_extents")
+        # Successful writes per spreadsheet, each of which bumps its version
+        self.writes = Counter()
+        self.writes_lock = threading.Lock()
+
+    # Services come from the calling thread's pool, so one client can be
+    # shared by worker threads
+    @property
+    def sheet_api(self):
+        return get_service("sheets", "v4")
+
+    @property
+    def sheet(self):
+        return get_sheet_service()
+
+    @property
+    def drive(self):
+        return get_drive_service()
+
+    @property
+    def permissions(self):
+        return get_permissions_service()
+
+    def __write(self, spreadsheet_id, request):
+        response = execute(request)
+        with self.writes_lock:
+            self.writes[spreadsheet_id] += 1
+        return response
+
+    def get_write_count(self, spreadsheet_id):
+        with self.writes_lock:
+            return self.writes[spreadsheet_id]
 
     def __batch_update_sheet(self, spreadsheet_id, requests):
-        self.sheet.batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body={"requests": requests},
-        ).execute()
+        return self.__write(
+            spreadsheet_id,
+            self.sheet.batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"requests": requests},
+            ),
+        )
 
     def get_values_from_sheet(self, sheet_range, spreadsheet_id):
-        result = (
-            self.sheet.values()
-            .get(
+        result = execute(
+            self.sheet.values().get(
                 spreadsheetId=spreadsheet_id,
                 range=sheet_range,
             )
-            .execute()
         )
         return result.get("values", [])
 
+    def batch_get_values_from_sheet(self, sheet_ranges, spreadsheet_id):
+        result = execute(
+            self.sheet.values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=list(sheet_ranges),
+            )
+        )
+        return [
+            value_range.get("values", [])
+            for value_range in result.get("valueRanges", [])
+        ]
+
+    def get_projected_values_from_sheet(
+        self, projection, sheet_name, first_row, spreadsheet_id
+    ):
+        # Read only the columns of the projection, in one request, as compact
+        # rows holding the projected columns in order
+        sheet_ranges = projection.get_ranges(sheet_name, first_row)
+        return projection.join(
+            self.batch_get_values_from_sheet(sheet_ranges, spreadsheet_id)
+        )
+
     def set_values_in_sheet(
         self, sheet_range, spreadsheet_id, values, clear_range=False
     ):
         if clear_range:
-            self.sheet.values().clear(
-                spreadsheetId=spreadsheet_id,
-                range=sheet_range,
-            ).execute()
+            self.__write(
+                spreadsheet_id, self.__clear_request(sheet_range, spreadsheet_id)
+            )
+
+        self.__write(
+            spreadsheet_id, self.__update_request(sheet_range, spreadsheet_id, values)
+        )
+
+    def batch_update_values(self, spreadsheet_id, value_ranges):
+        # Write many ranges of one spreadsheet with as few requests as possible
+        for chunk in chunked(value_ranges, VALUE_RANGES_PER_REQUEST):
+            self.__write(
+                spreadsheet_id,
+                self.sheet.values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={
+                        "valueInputOption": USER_ENTERED,
+                        "data": [
+                            {"range": sheet_range, "values": values}
+                            for sheet_range, values in chunk
+                        ],
+                    },
+                ),
+            )
+
+    def __execute_batch(self, request_factories):
+        # Send requests in multi-part HTTP batches, resubmitting only the
+        # sub-requests that failed with a retryable error
+        pending = dict(request_factories)
+        responses = {}
+        failed = {}
+
+        for attempt in range(MAX_ATTEMPTS):
+            retry = {}
+
+            requests = {}
+
+            def callback(request_id, response, exception):
+                method_id = requests[request_id].methodId
+                METRICS.record(
+                    get_resource(method_id),
+                    method_id,
+                    payload_bytes=get_payload_bytes(requests[request_id]),
+                    retry=attempt > 0,
+                    error=exception,
+                )
 
-        self.sheet.values().update(
+                if exception is None:
+                    responses[request_id] = response
+                    return
+                if is_retryable(exception, method_id):
+                    retry[request_id] = exception
+                else:
+                    failed[request_id] = exception
+
+            request_ids = list(pending)
+            for i in range(0, len(request_ids), BATCH_SIZE):
+                chunk = request_ids[i : i + BATCH_SIZE]
+                batch = self.sheet_api.new_batch_http_request(callback=callback)
+                for request_id in chunk:
+                    requests[request_id] = pending[request_id]()
+                    batch.add(requests[request_id], request_id=request_id)
+
+                # Every sub-request counts against the quota
+                BUCKETS["sheets.write"].acquire(len(chunk))
+                try:
+                    with track("sheets", "batch", retry=attempt > 0):
+                        batch.execute()
+                except HttpError as e:
+                    if not all(
+                        is_retryable(e, requests[request_id].methodId)
+                        for request_id in chunk
+                    ):
+                        raise
+                    # The batch itself was rejected, so retry all of it
+                    retry.update({request_id: e for request_id in chunk})
+
+            pending = {request_id: pending[request_id] for request_id in retry}
+            if not pending:
+                break
+
+            if attempt + 1 < MAX_ATTEMPTS:
+                delay = max(get_backoff(attempt, e) for e in retry.values())
+                print(
+                    f"[ERROR] {len(pending)} batched requests failed (likely "
+                    f"rate-limit), retrying in {delay:.1f}s"
+                )
+                sleep(delay)
+            else:
+                failed.update(retry)
+
+        return responses, failed
+
+    def __clear_request(self, sheet_range, spreadsheet_id):
+        return self.sheet.values().clear(
+            spreadsheetId=spreadsheet_id,
+            range=sheet_range,
+        )
+
+    def __update_request(self, sheet_range, spreadsheet_id, values):
+        return self.sheet.values().update(
             spreadsheetId=spreadsheet_id,
             range=sheet_range,
             valueInputOption=USER_ENTERED,
             body={"values": values},
-        ).execute()
+        )
+
+    def batch_set_values_in_sheets(
+        self, sheet_range, values_by_spreadsheet_id, clear_range=False
+    ):
+        # Write values to the same range of many spreadsheets, returning a map
+        # of spreadsheet ID to error for every spreadsheet that failed
+        failed = {}
+        writes = dict(values_by_spreadsheet_id)
+
+        if clear_range:
+            # Where the extent of the last write is known, blank it out in the
+            # same request rather than clearing the range first
+            to_clear = []
+            for spreadsheet_id, values in values_by_spreadsheet_id.items():
+                key = self.__get_extent_key(spreadsheet_id, sheet_range)
+                extent = self.sheet_extents.get(key)
+                if extent is None:
+                    to_clear.append(spreadsheet_id)
+                    continue
+
+                writes[spreadsheet_id] = pad_values(values, *extent)
+                # Never let a crash mid-write leave the recorded extent too small
+                new_extent = get_extent(values)
+                self.sheet_extents.set(
+                    key, [max(extent[0], new_extent[0]), max(extent[1], new_extent[1])]
+                )
+            self.sheet_extents.save()
+
+            if to_clear:
+                _, failed = self.__execute_batch(
+                    {
+                        spreadsheet_id: partial(
+                            self.__clear_request, sheet_range, spreadsheet_id
+                        )
+                        for spreadsheet_id in to_clear
+                    }
+                )
+
+        _, update_failed = self.__execute_batch(
+            {
+                spreadsheet_id: partial(
+                    self.__update_request, sheet_range, spreadsheet_id, values
+                )
+                for spreadsheet_id, values in writes.items()
+                if spreadsheet_id not in failed
+            }
+        )
+        failed.update(update_failed)
+
+        if clear_range:
+            for spreadsheet_id, values in values_by_spreadsheet_id.items():
+                if spreadsheet_id not in failed:
+                    self.sheet_extents.set(
+                        self.__get_extent_key(spreadsheet_id, sheet_range),
+                        get_extent(values),
+                    )
+            self.sheet_extents.save(force=False)
+
+        return failed
+
+    def __get_extent_key(self, spreadsheet_id, sheet_range):
+        return f"{spreadsheet_id}/{sheet_range}"
 
     def get_sheets_from_spreadsheet(self, spreadsheet_id, as_dict=False):
-        result = self.sheet.get(spreadsheetId=spreadsheet_id).execute()
+        result = execute(
+            self.sheet.get(
+                spreadsheetId=spreadsheet_id,
+                fields="sheets.properties(sheetId,title)",
+            )
+        )
         if as_dict:
             return {
                 sheet["properties"]["title"]: sheet["properties"]["sheetId"]
@@ -58,6 +300,152 @@ class GoogleCloudClient:
         else:
             return [sheet["properties"]["title"] for sheet in result["sheets"]]
 
+    def get_file_version(self, file_id):
+        # Drive bumps a file's version on every change to its contents
+        file = execute(self.drive.get(fileId=file_id, fields="version"))
+        return file["version"]
+
+    def get_sheet_properties(self, spreadsheet_id):
+        result = execute(
+            self.sheet.get(
+                spreadsheetId=spreadsheet_id,
+                fields="sheets.properties(sheetId,title,gridProperties)",
+            )
+        )
+        return {
+            sheet["properties"]["title"]: sheet["properties"]
+            for sheet in result["sheets"]
+        }
+
+    def replace_sheet_values(
+        self, spreadsheet_id, sheet_name, rows, workers=UPLOAD_WORKERS
+    ):
+        # Upload into a hidden staging sheet, then swap it in with a single
+        # batchUpdate so that readers never see a half-written sheet. The
+        # staging sheet is sized up front, so every row is held at once
+        rows = list(rows)
+        num_rows = max(len(rows), 1)
+        num_columns = max([1] + [len(row) for row in rows])
+        staging_name = f"{sheet_name}{STAGING_SHEET_SUFFIX}"
+        sheets = self.get_sheet_properties(spreadsheet_id)
+
+        requests = []
+        if staging_name in sheets:
+            # Left behind by an upload that failed
+            requests.append(
+                {"deleteSheet": {"sheetId": sheets[staging_name]["sheetId"]}}
+            )
+        requests.append(
+            {
+                "addSheet": {
+                    "properties": {
+                        "title": staging_name,
+                        "hidden": True,
+                        "gridProperties": {
+                            "rowCount": num_rows,
+                            "columnCount": num_columns,
+                        },
+                    }
+                }
+            }
+        )
+        replies = self.__batch_update_sheet(spreadsheet_id, requests)["replies"]
+        staging_id = replies[-1]["addSheet"]["properties"]["sheetId"]
+
+        # Upload size-bounded chunks of rows in parallel, paced by the shared
+        # rate limiter
+        chunks = []
+        row = 1
+        for chunk in chunk_rows(rows, UPLOAD_CHUNK_BYTES):
+            chunks.append((f"{staging_name}!A{row}", chunk))
+            row += len(chunk)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(
+                        self.set_values_in_sheet, sheet_range, spreadsheet_id, chunk
+                    )
+                    for sheet_range, chunk in chunks
+                ]
+                for future in futures:
+                    future.result()
+        except Exception:
+            self.__batch_update_sheet(
+                spreadsheet_id, [{"deleteSheet": {"sheetId": staging_id}}]
+            )
+            raise
+
+        target = sheets.get(sheet_name)
+        if target is None:
+            self.__batch_update_sheet(
+                spreadsheet_id,
+                [
+                    {
+                        "updateSheetProperties": {
+                            "properties": {
+                                "sheetId": staging_id,
+                                "title": sheet_name,
+                                "hidden": False,
+                            },
+                            "fields": "title,hidden",
+                        }
+                    }
+                ],
+            )
+            return
+
+        # Copy values into the existing sheet rather than replacing it, so
+        # formulas elsewhere that refer to it keep working
+        requests = []
+        grid = target.get("gridProperties", {})
+        if (
+            grid.get("rowCount", 0) < num_rows
+            or grid.get("columnCount", 0) < num_columns
+        ):
+            requests.append(
+                {
+                    "updateSheetProperties": {
+                        "properties": {
+                            "sheetId": target["sheetId"],
+                            "gridProperties": {
+                                "rowCount": max(grid.get("rowCount", 0), num_rows),
+                                "columnCount": max(
+                                    grid.get("columnCount", 0), num_columns
+                                ),
+                            },
+                        },
+                        "fields": "gridProperties.rowCount,gridProperties.columnCount",
+                    }
+                }
+            )
+
+        grid_range = {
+            "startRowIndex": 0,
+            "endRowIndex": num_rows,
+            "startColumnIndex": 0,
+            "endColumnIndex": num_columns,
+        }
+        requests.extend(
+            [
+                {
+                    "updateCells": {
+                        "range": {"sheetId": target["sheetId"]},
+                        "fields": "userEnteredValue",
+                    }
+                },
+                {
+                    "copyPaste": {
+                        "source": dict(grid_range, sheetId=staging_id),
+                        "destination": dict(grid_range, sheetId=target["sheetId"]),
+                        "pasteType": "PASTE_VALUES",
+                    }
+                },
+                {"deleteSheet": {"sheetId": staging_id}},
+            ]
+        )
+        self.__batch_update_sheet(spreadsheet_id, requests)
+
     def create_sheet_in_spreadsheet(self, spreadsheet_id, sheet_name, header=None):
         self.__batch_update_sheet(
             spreadsheet_id,
@@ -68,7 +456,7 @@ class GoogleCloudClient:
         if header:
             self.set_values_in_sheet(
                 sheet_range=sheet_name,
-                spreadsheet_id=self.spreadsheet_id,
+                spreadsheet_id=spreadsheet_id,
                 values=[header],
             )
 
@@ -78,64 +466,52 @@ class GoogleCloudClient:
             "properties": {"title": name},
             "sheets": [{"properties": {"title": sheet}} for sheet in sheets],
         }
-        response = self.sheet.create(body=create).execute()
+        response = execute(self.sheet.create(body=create))
         ssid = response["spreadsheetId"]
 
+        # Every sheet of a new spreadsheet starts out empty
+        for sheet in sheets:
+            self.sheet_extents.set(self.__get_extent_key(ssid, sheet), [0, 0])
+
         # Move spreadsheet to folder
-        file = self.drive.get(fileId=ssid, fields="parents").execute()
+        file = execute(self.drive.get(fileId=ssid, fields="parents"))
         previous_parents = ",".join(file.get("parents"))
-        file = self.drive.update(
-            fileId=ssid,
-            addParents=destination,
-            removeParents=previous_parents,
-            fields="id, parents",
-        ).execute()
+        file = execute(
+            self.drive.update(
+                fileId=ssid,
+                addParents=destination,
+                removeParents=previous_parents,
+                fields="id, parents",
+            )
+        )
 
         # Share spreadsheet with emails
         for email_id in email_ids:
             share = {"role": "writer", "type": "user", "emailAddress": email_id}
-            self.permissions.create(body=share, fileId=ssid).execute()
+            execute(self.permissions.create(body=share, fileId=ssid))
 
         return ssid
 
-    def copy_sheets_to_spreadsheet(
-        self,
-        source_spreadsheet_id,
-        source_sheet_names,
-        destination_spreadsheet_id,
-        destination_sheet_names,
-    ):
-        requests = []
-
-        map_source_sheet_name_to_id = self.get_sheets_from_spreadsheet(
-            spreadsheet_id=source_spreadsheet_id, as_dict=True
-        )
-        map_destination_sheet_name_to_id = self.get_sheets_from_spreadsheet(
-            spreadsheet_id=destination_spreadsheet_id, as_dict=True
+    def __copy_request(self, source_spreadsheet_id, source_sheet_id, destination):
+        return self.sheet.sheets().copyTo(
+            spreadsheetId=source_spreadsheet_id,
+            sheetId=source_sheet_id,
+            body={"destination_spreadsheet_id": destination},
         )
 
-        for source_sheet_name, destination_sheet_name in zip(
-            source_sheet_names, destination_sheet_names
-        ):
-            destination_sheet_id = map_destination_sheet_name_to_id.get(
-                destination_sheet_name
-            )
+    def __get_view_requests(self, map_destination_sheet_name_to_id, new_sheets):
+        requests = []
+        layout = {
+            sheet_name: sheet_id
+            for sheet_name, sheet_id in map_destination_sheet_name_to_id.items()
+            if sheet_id not in new_sheets.values()
+        }
+
+        for destination_sheet_name, new_sheet_id in new_sheets.items():
+            destination_sheet_id = layout.pop(destination_sheet_name, None)
             if destination_sheet_id is not None:
                 requests.append({"deleteSheet": {"sheetId": destination_sheet_id}})
 
-            # Copy source_sheet to destination
-            source_sheet_id = map_source_sheet_name_to_id.get(source_sheet_name)
-            response = (
-                self.sheet.sheets()
-                .copyTo(
-                    spreadsheetId=source_spreadsheet_id,
-                    sheetId=source_sheet_id,
-                    body={"destination_spreadsheet_id": destination_spreadsheet_id},
-                )
-                .execute()
-            )
-            new_sheet_id = response["sheetId"]
-
             # Refactor new sheet
             requests.append(
                 {
@@ -150,19 +526,107 @@ class GoogleCloudClient:
                 }
             )
 
-        # Delete any sheets to delete, if they still exist
-        for sheet in CARD_SHEETS_TO_DELETE:
-            destination_sheet_id = map_destination_sheet_name_to_id.get(sheet)
-            if destination_sheet_id is not None:
-                requests.append({"deleteSheet": {"sheetId": destination_sheet_id}})
+        # Delete any sheets to delete, if they still exist, along with copies
+        # left by interrupted updates, which Sheets numbers "Copy of X 2"
+        for sheet in list(layout):
+            if STRAY_COPY_PATTERN.fullmatch(sheet):
+                requests.append({"deleteSheet": {"sheetId": layout.pop(sheet)}})
+
+        layout.update(new_sheets)
+        return requests, layout
 
-        self.__batch_update_sheet(destination_spreadsheet_id, requests)
+    def copy_sheets_to_spreadsheet(
+        self,
+        source_spreadsheet_id,
+        source_sheet_names,
+        destination_spreadsheet_id,
+        destination_sheet_names,
+    ):
+        # The template does not change during a run, so look its sheets up once
+        if source_spreadsheet_id not in self.sheet_id_cache:
+            self.sheet_id_cache[source_spreadsheet_id] = (
+                self.get_sheets_from_spreadsheet(
+                    spreadsheet_id=source_spreadsheet_id, as_dict=True
+                )
+            )
+        map_source_sheet_name_to_id = self.sheet_id_cache[source_spreadsheet_id]
+
+        # Forget the card's layout until the copies are tidied up, so a card
+        # left with stray copies by an interrupted update is fetched next time.
+        # This must reach disk before copying, in case the process is killed
+        layout = self.card_layouts.get(destination_spreadsheet_id)
+        if layout is not None:
+            self.card_layouts.delete(destination_spreadsheet_id)
+            self.card_layouts.save()
+
+        # Copy every source sheet to destination in a single batch
+        responses, failed = self.__execute_batch(
+            {
+                str(i): partial(
+                    self.__copy_request,
+                    source_spreadsheet_id,
+                    map_source_sheet_name_to_id.get(source_sheet_name),
+                    destination_spreadsheet_id,
+                )
+                for i, source_sheet_name in enumerate(source_sheet_names)
+            }
+        )
+        if failed:
+            raise next(iter(failed.values()))
+
+        new_sheets = {
+            destination_sheet_name: responses[str(i)]["sheetId"]
+            for i, destination_sheet_name in enumerate(destination_sheet_names)
+        }
+
+        # Apply every structural edit in one batchUpdate, using the layout left
+        # by the last update when there is one and fetching it otherwise
+        if layout is not None:
+            requests, layout = self.__get_view_requests(layout, new_sheets)
+            try:
+                self.__batch_update_sheet(destination_spreadsheet_id, requests)
+            except HttpError as e:
+                # The card was changed by hand since it was last updated
+                if e.resp.status != 400:
+                    raise
+                layout = None
+
+        if layout is None:
+            requests, layout = self.__get_view_requests(
+                self.get_sheets_from_spreadsheet(
+                    spreadsheet_id=destination_spreadsheet_id, as_dict=True
+                ),
+                new_sheets,
+            )
+            self.__batch_update_sheet(destination_spreadsheet_id, requests)
+
+        self.card_layouts.set(destination_spreadsheet_id, layout)
+        self.card_layouts.save(force=False)
 
 
 class GradescopeClient:
     def __init__(self):
         self.client = GoogleCloudClient()
-        self.assignments = gradescope.get_course_assignments(GRADESCOPE_COURSE_ID)
+        self.cache = GradescopeCache(GRADESCOPE_COURSE_ID)
+        self.refresh_assignments()
+
+    def refresh_assignments(self):
+        self.assignments = self.cache.get_assignments(self.__fetch_assignments)
+
+    def __fetch_assignments(self):
+        # Only import the Gradescope scraper when the cache cannot answer
+        import gradescope
+
+        with track("gradescope", "get_course_assignments"):
+            return gradescope.get_course_assignments(GRADESCOPE_COURSE_ID)
+
+    def __fetch_evaluations(self, assignment_id):
+        import gradescope
+
+        with track("gradescope", "get_assignment_evaluations"):
+            return gradescope.get_assignment_evaluations(
+                GRADESCOPE_COURSE_ID, assignment_id
+            )
 
     def get_assignment_by_name(self, assignment_name):
         for assignment in self.assignments:
@@ -171,7 +635,36 @@ class GradescopeClient:
 
         raise KeyError("No Assignment Found")
 
+    def get_assignment_by_id(self, assignment_id):
+        for assignment in self.assignments:
+            if assignment_id == assignment["id"]:
+                return assignment
+
+        raise KeyError("No Assignment Found")
+
     def get_evaluation_data_by_assignment_id(self, assignment_id):
-        return gradescope.get_assignment_evaluations(
-            GRADESCOPE_COURSE_ID, assignment_id
+        return self.cache.get_evaluations(
+            self.get_assignment_by_id(assignment_id),
+            partial(self.__fetch_evaluations, assignment_id),
         )
+
+    def get_evaluation_meta(self, assignment_id):
+        # When the evaluations were last fetched, and since when they have
+        # been final, or None if they are not cached
+        return self.cache.get_evaluations_meta(self.get_assignment_by_id(assignment_id))
+
+    def clear_cache(self, assignment_names=None):
+        if assignment_names is None:
+            self.cache.invalidate()
+            return
+
+        assignment_ids = []
+        for assignment_name in assignment_names:
+            try:
+                assignment = self.get_assignment_by_name(assignment_name)
+            except KeyError:
+                continue
+
+            assignment_ids.append(assignment["id"])
+
+        self.cache.invalidate(assignment_ids)
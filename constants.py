@@ -1,11 +1,13 @@
 EXPORT_SHEET_NAME = "export"
-EXPORT_SHEET_RANGE_R = f"{EXPORT_SHEET_NAME}!A3:NP"  # haha, easter egg
-EXPORT_SHEET_RANGE_W = f"{EXPORT_SHEET_NAME}!A3:E"
+EXPORT_FIRST_ROW = 3
+EXPORT_SHEET_RANGE_R = f"{EXPORT_SHEET_NAME}!A{EXPORT_FIRST_ROW}:NP"  # haha, easter egg
+EXPORT_SHEET_RANGE_W = f"{EXPORT_SHEET_NAME}!A{EXPORT_FIRST_ROW}:E"
 EXPORT_SHEET_RANGE_HEADER = f"{EXPORT_SHEET_NAME}!1:1"
 EXPORT_HEADER = ["andrew_id", "email", "ssid", "_ssid", "last_updated"]
 
 ROSTER_SHEET_NAME = "roster"
-ROSTER_SHEET_RANGE_W = f"{ROSTER_SHEET_NAME}!A2:NP"
+ROSTER_FIRST_ROW = 2
+ROSTER_SHEET_RANGE_W = f"{ROSTER_SHEET_NAME}!A{ROSTER_FIRST_ROW}:NP"
 ROSTER_HEADER = [
     "Semester",
     "Course",
@@ -43,8 +45,64 @@ ROSTER_HEADER = [
     "Roster As Of Date",
 ]
 
+# Roster columns that change on every registrar export, and so never count
+# as a change to a student
+ROSTER_VOLATILE_COLUMNS = ["Roster As Of Date"]
+
 USER_ENTERED = "USER_ENTERED"
 
+# Per-user Google API quotas, in requests per minute
+SHEETS_READS_PER_MINUTE = 60
+SHEETS_WRITES_PER_MINUTE = 60
+DRIVE_REQUESTS_PER_MINUTE = 12000
+
+# Retries for rate-limited or failed requests, with exponential backoff
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# Requests that create something may have gone through when they time out or
+# fail on the server, so they are only retried when rate limited
+NON_IDEMPOTENT_METHODS = (
+    "sheets.spreadsheets.create",
+    "sheets.spreadsheets.sheets.copyTo",
+    "drive.permissions.create",
+)
+RATE_LIMITED_STATUS_CODE = 429
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 2
+BACKOFF_MAX = 64
+
+# Sub-requests per multi-part HTTP batch, and ranges per values().batchUpdate
+BATCH_SIZE = 50
+VALUE_RANGES_PER_REQUEST = 1000
+
+# Seconds before a request to Google is abandoned
+HTTP_TIMEOUT = 60
+
+# Students whose card data is sent together by sync_data
+SYNC_BATCH_SIZE = 100
+
+# Worker threads used by create_cards, and how many finished cards are
+# written back to the export sheet at a time, or at least every so many
+# seconds
+CREATE_CARDS_WORKERS = 8
+EXPORT_FLUSH_SIZE = 5
+EXPORT_FLUSH_INTERVAL = 30
+
+# Finished students whose last_updated is written back to the export sheet
+# together by update_views and sync_data, and the longest wait in seconds
+CHECKPOINT_FLUSH_SIZE = 100
+CHECKPOINT_FLUSH_INTERVAL = 60
+
+# Parallel requests and largest request body used when uploading a sheet,
+# and the suffix of the hidden sheet it is uploaded to before being swapped in
+UPLOAD_WORKERS = 4
+UPLOAD_CHUNK_BYTES = 2 * 2**20
+STAGING_SHEET_SUFFIX = "_uploading"
+
+# Concurrent Gradescope downloads when loading several configs, and how many
+# finished items may wait between pipeline stages
+GRADESCOPE_FETCH_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 2
+
 DATA_SHEET_NAME = "Data"
 CARD_VIEWS = ["Dashboard", "Scores"]
 CARD_SHEETS = CARD_VIEWS + [DATA_SHEET_NAME]
@@ -57,9 +115,35 @@ MAP_ACTION_TO_ATTRIBUTE = {
     "Update views": ("GoogleCloudResource", "post_update_card_views"),
     "Sync data": ("GoogleCloudResource", "post_update_card_data"),
     "Load Gradescope data": ("GradescopeResource", "post_load_data"),
+    "Clear Gradescope cache": ("GradescopeResource", "post_clear_cache"),
 }
 
 ROSTER_PATH = "roster"
 CONFIG_PATH = "config"
+STATE_PATH = "state"
+STATE_SAVE_INTERVAL = 10
+MIRROR_PATH = f"{STATE_PATH}/mirror.sqlite3"
+CACHE_PATH = "cache"
+METRICS_PATH = "metrics"
+
+# Upper bounds, in seconds, of the API latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Seconds before cached Gradescope data is fetched again. Evaluations of
+# published assignments that stay fully graded this long are never refetched
+GRADESCOPE_CATALOG_TTL = 60 * 60
+GRADESCOPE_EVALUATIONS_TTL = 10 * 60
+GRADESCOPE_FINAL_AFTER = 7 * 24 * 60 * 60
 
 STAR_THRESHOLD = 0.01
+
+# Seconds between daemon polls of an assignment that is still being graded,
+# of one that is fully graded but may still be regraded, and after a failed
+# poll. Final assignments are not polled again. The daemon wakes at least
+# every DAEMON_TICK seconds to pick up new configs and refresh its status
+DAEMON_GRADING_INTERVAL = GRADESCOPE_EVALUATIONS_TTL
+DAEMON_GRADED_INTERVAL = 60 * 60
+DAEMON_RETRY_INTERVAL = 60
+DAEMON_TICK = 60
+DAEMON_STATUS_PATH = f"{STATE_PATH}/daemon.json"
+DAEMON_JOURNAL_NAME = "daemon_sync_data"
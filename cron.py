@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+from metrics import METRICS
 from resource import GradescopeResource
 
 
 def main():
     # Run Gradescope autopull
-    gradescope_resource = GradescopeResource()
-    gradescope_resource.post_load_data(load_all_data=True)
+    try:
+        gradescope_resource = GradescopeResource()
+        gradescope_resource.post_load_data(load_all_data=True)
+    finally:
+        METRICS.dump("cron")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+
+from constants import (
+    GRADESCOPE_FINAL_AFTER,
+    DAEMON_GRADING_INTERVAL,
+    DAEMON_GRADED_INTERVAL,
+    DAEMON_RETRY_INTERVAL,
+    DAEMON_TICK,
+    DAEMON_STATUS_PATH,
+    DAEMON_JOURNAL_NAME,
+)
+from metrics import METRICS
+from service import GradescopeService
+from state import get_state_store
+from util import fingerprint
+
+
+class Daemon:
+    # Keeps one set of clients and caches warm, and refreshes each config's
+    # Gradescope data, gradecard sheet and student cards on its own schedule
+    def __init__(self):
+        self.service = GradescopeService()
+        self.upload_fingerprints = get_state_store("upload_fingerprints")
+        self.stopping = threading.Event()
+        self.started_at = time.time()
+
+        # Config file -> (plan, next poll time or None for never)
+        self.schedule = {}
+        self.queue = []
+        self.upload_pending = {}
+        # Sync once on start, in case the last run stopped before syncing
+        self.sync_pending_since = self.started_at
+        self.last_run = {}
+
+    def get_interval(self, config_data, assignments):
+        if config_data.poll_interval is not None:
+            return config_data.poll_interval
+
+        if not any(assignments):
+            return DAEMON_GRADED_INTERVAL
+
+        # Poll often while an assignment is being graded, rarely once it is
+        # fully graded, and never once the cache considers it final
+        intervals = []
+        for assignment in filter(None, assignments):
+            meta = self.service.client.get_evaluation_meta(assignment["id"])
+            final_since = None if meta is None else meta.get("final_since")
+            if final_since is None:
+                intervals.append(DAEMON_GRADING_INTERVAL)
+            elif time.time() - final_since < GRADESCOPE_FINAL_AFTER:
+                intervals.append(DAEMON_GRADED_INTERVAL)
+
+        return min(intervals, default=None)
+
+    def get_due_configs(self):
+        self.service.client.refresh_assignments()
+        configs = [config["value"] for config in self.service.get_configs()]
+
+        for config in set(self.schedule) - set(configs):
+            del self.schedule[config]
+            self.upload_pending.pop(config, None)
+
+        # A new or edited config is due straight away
+        current = time.time()
+        due = []
+        for config in configs:
+            try:
+                plan = self.service.read_config(config)
+            except ValueError:
+                plan = None
+            scheduled_plan, next_poll = self.schedule.get(config, (None, None))
+            if config not in self.schedule or plan != scheduled_plan:
+                next_poll = current
+                self.schedule[config] = (plan, next_poll)
+            if next_poll is not None and next_poll <= current:
+                due.append(config)
+
+        due.sort(key=lambda config: self.schedule[config][1])
+        return due
+
+    def refresh_config(self, config):
+        job = self.service.prepare_config(config)
+        if job is None:
+            return DAEMON_GRADED_INTERVAL
+
+        _, config_data, assignment, cyu_assignment = job
+        data, sheet_name = self.service.transform_config_data(
+            *self.service.fetch_config_data(*job)
+        )
+        self.last_run["fetch"] = time.time()
+
+        # Only upload grids that differ from the last one uploaded
+        rows = list(data)
+        rows_fingerprint = fingerprint(rows)
+        if self.upload_fingerprints.get(sheet_name) == rows_fingerprint:
+            print(f"[INFO] {sheet_name} is unchanged, skipping upload")
+            self.upload_pending.pop(config, None)
+        else:
+            self.upload_pending.setdefault(config, time.time())
+            self.service.gcp_service.load_gradescope_data(rows, sheet_name)
+            self.upload_fingerprints.set(sheet_name, rows_fingerprint)
+            self.upload_fingerprints.save()
+            self.last_run["upload"] = time.time()
+
+            self.sync_pending_since = self.sync_pending_since or time.time()
+            del self.upload_pending[config]
+
+        return self.get_interval(config_data, [assignment, cyu_assignment])
+
+    def sync_cards(self):
+        # Students whose cards are unchanged are skipped by their fingerprints.
+        # A journal of its own leaves an interrupted manual sync resumable
+        self.service.gcp_service.sync_data(
+            ["student"], incremental=True, journal_name=DAEMON_JOURNAL_NAME
+        )
+        self.last_run["sync"] = time.time()
+        self.sync_pending_since = None
+
+    def run_cycle(self):
+        self.queue = self.get_due_configs()
+        self.write_status("running")
+
+        while self.queue and not self.stopping.is_set():
+            config = self.queue[0]
+            try:
+                interval = self.refresh_config(config)
+            except Exception as e:
+                print(f"[ERROR] Refreshing {config} failed: {e}")
+                interval = DAEMON_RETRY_INTERVAL
+
+            plan, _ = self.schedule[config]
+            next_poll = None if interval is None else time.time() + interval
+            self.schedule[config] = (plan, next_poll)
+            if next_poll is None:
+                print(f"[INFO] {config} is final, no longer polling it")
+
+            self.queue.pop(0)
+            self.write_status("running")
+
+        if self.sync_pending_since is not None and not self.stopping.is_set():
+            try:
+                self.sync_cards()
+            except Exception as e:
+                print(f"[ERROR] Syncing card data failed: {e}")
+            self.write_status("running")
+
+    def get_sleep(self):
+        next_polls = [
+            next_poll
+            for _, next_poll in self.schedule.values()
+            if next_poll is not None
+        ]
+        sleep = min(next_polls, default=time.time() + DAEMON_TICK) - time.time()
+        # Retry a failed sync on the next tick
+        if self.sync_pending_since is not None:
+            sleep = min(sleep, DAEMON_RETRY_INTERVAL)
+        return max(0, min(sleep, DAEMON_TICK))
+
+    def run(self, once=False):
+        print(f"[INFO] Daemon started with pid {os.getpid()}")
+        while not self.stopping.is_set():
+            self.run_cycle()
+            if once:
+                break
+
+            self.write_status("idle")
+            self.stopping.wait(self.get_sleep())
+
+    def get_status(self, state):
+        current = time.time()
+        due = [self.schedule[config][1] for config in self.queue]
+        pending_since = {
+            "fetch": min(due, default=None),
+            "upload": min(self.upload_pending.values(), default=None),
+            "sync": self.sync_pending_since,
+        }
+
+        return {
+            "state": state,
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "updated_at": current,
+            "queue_depth": len(self.queue),
+            "stages": {
+                stage: {
+                    "last_run": self.last_run.get(stage),
+                    # Seconds the oldest work waiting on this stage has waited
+                    "lag": 0 if since is None else round(current - since, 3),
+                }
+                for stage, since in pending_since.items()
+            },
+            "configs": {
+                config: {
+                    "name": None if plan is None else plan.name,
+                    "next_poll": next_poll,
+                }
+                for config, (plan, next_poll) in sorted(self.schedule.items())
+            },
+        }
+
+    def write_status(self, state):
+        os.makedirs(os.path.dirname(DAEMON_STATUS_PATH), exist_ok=True)
+        with open(f"{DAEMON_STATUS_PATH}.tmp", "w") as f:
+            json.dump(self.get_status(state), f, indent=2)
+        os.replace(f"{DAEMON_STATUS_PATH}.tmp", DAEMON_STATUS_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep gradecards in sync with Gradescope"
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="run a single refresh cycle and exit"
+    )
+    args = parser.parse_args()
+
+    # Nobody is around to confirm pulling unpublished assignments
+    os.environ.setdefault("GC_HEADLESS", "true")
+    daemon = Daemon()
+
+    def stop(signum, frame):
+        # Finish the current stage first; a second signal stops immediately
+        if daemon.stopping.is_set():
+            raise KeyboardInterrupt
+        print("[INFO] Stopping after the current stage")
+        daemon.stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        daemon.run(args.once)
+    finally:
+        daemon.write_status("stopped")
+        METRICS.dump("daemon")
+
+
+if __name__ == "__main__":
+    main()
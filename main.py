@@ -1,15 +1,32 @@
 #!/usr/bin/env python3
-from cli import prompt_action
+import sys
+
+from cli import prompt_action, parse_args
 from constants import MAP_ACTION_TO_ATTRIBUTE
+from metrics import METRICS
 import resource
 
 
 def main():
-    action = prompt_action()
+    # Run the action given on the command line, or prompt for one
+    if len(sys.argv) > 1:
+        action, arguments = parse_args()
+    else:
+        action, arguments = prompt_action(), {}
     resource_name, attribute = MAP_ACTION_TO_ATTRIBUTE[action]
 
-    resource_inst = resource.__getattribute__(resource_name)()
-    resource_inst.__getattribute__(attribute)()
+    # Dry runs only read, and print what the action would do
+    if arguments.pop("plan", False):
+        from planner import Planner
+
+        Planner().__getattribute__(attribute)(**arguments).print()
+        return
+
+    try:
+        resource_inst = resource.__getattribute__(resource_name)()
+        resource_inst.__getattribute__(attribute)(**arguments)
+    finally:
+        METRICS.dump(attribute)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+from constants import METRICS_PATH, LATENCY_BUCKETS
+
+
+def get_resource(method_id):
+    # Label calls by the API they hit, e.g. "drive.permissions.create"
+    api, _, rest = method_id.partition(".")
+    if api == "drive" and rest.startswith("permissions."):
+        return "permissions"
+    return api
+
+
+def get_payload_bytes(request):
+    body = request.body or b""
+    return len(body.encode() if isinstance(body, str) else body)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def __get_series(self, resource, method):
+        key = (resource, method)
+        if key not in self.series:
+            self.series[key] = {
+                "count": 0,
+                "retries": 0,
+                "payload_bytes": 0,
+                "errors": Counter(),
+                "latency_count": 0,
+                "latency_sum": 0.0,
+                "latency_buckets": [0] * len(LATENCY_BUCKETS),
+            }
+        return self.series[key]
+
+    def record(
+        self,
+        resource,
+        method,
+        latency=None,
+        payload_bytes=0,
+        retry=False,
+        error=None,
+    ):
+        with self.lock:
+            series = self.__get_series(resource, method)
+            series["count"] += 1
+            series["retries"] += int(retry)
+            series["payload_bytes"] += payload_bytes
+            if error is not None:
+                series["errors"][error.__class__.__name__] += 1
+
+            # Calls sent inside a batch have no latency of their own
+            if latency is not None:
+                series["latency_count"] += 1
+                series["latency_sum"] += latency
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        series["latency_buckets"][i] += 1
+                        break
+
+    def to_json(self):
+        with self.lock:
+            return [
+                {
+                    "resource": resource,
+                    "method": method,
+                    "count": series["count"],
+                    "retries": series["retries"],
+                    "payload_bytes": series["payload_bytes"],
+                    "errors": dict(series["errors"]),
+                    "latency": {
+                        "count": series["latency_count"],
+                        "sum": round(series["latency_sum"], 6),
+                        "buckets": dict(
+                            zip(map(str, LATENCY_BUCKETS), series["latency_buckets"])
+                        ),
+                    },
+                }
+                for (resource, method), series in sorted(self.series.items())
+            ]
+
+    def to_prometheus(self):
+        lines = []
+
+        def add(name, kind, samples):
+            if kind is not None:
+                lines.append(f"# TYPE gradecard_api_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"gradecard_api_{name}{{{label_text}}} {value}")
+
+        with self.lock:
+            series = sorted(self.series.items())
+            labels = [({"resource": r, "method": m}, s) for (r, m), s in series]
+
+            add("requests_total", "counter", [(l, s["count"]) for l, s in labels])
+            add("retries_total", "counter", [(l, s["retries"]) for l, s in labels])
+            add(
+                "errors_total",
+                "counter",
+                [
+                    (dict(l, error=error), count)
+                    for l, s in labels
+                    for error, count in sorted(s["errors"].items())
+                ],
+            )
+            add(
+                "payload_bytes_total",
+                "counter",
+                [(l, s["payload_bytes"]) for l, s in labels],
+            )
+
+            histogram = []
+            for l, s in labels:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, s["latency_buckets"]):
+                    cumulative += count
+                    histogram.append((dict(l, le=str(bound)), cumulative))
+                histogram.append((dict(l, le="+Inf"), s["latency_count"]))
+            lines.append("# TYPE gradecard_api_latency_seconds histogram")
+            add("latency_seconds_bucket", None, histogram)
+            add(
+                "latency_seconds_sum",
+                None,
+                [(l, round(s["latency_sum"], 6)) for l, s in labels],
+            )
+            add(
+                "latency_seconds_count",
+                None,
+                [(l, s["latency_count"]) for l, s in labels],
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, name):
+        # Keep one JSON file per run, and the latest run for Prometheus
+        if not self.series:
+            return
+
+        os.makedirs(METRICS_PATH, exist_ok=True)
+        timestamp = dt.now().strftime("%Y%m%d-%H%M%S")
+        with open(os.path.join(METRICS_PATH, f"{timestamp}-{name}.json"), "w") as f:
+            json.dump({"run": name, "time": timestamp, "series": self.to_json()}, f)
+        with open(os.path.join(METRICS_PATH, f"{name}.prom"), "w") as f:
+            f.write(self.to_prometheus())
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def track(resource, method, payload_bytes=0, retry=False):
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        METRICS.record(
+            resource,
+            method,
+            latency=time.perf_counter() - start,
+            payload_bytes=payload_bytes,
+            retry=retry,
+            error=error,
+        )
@@ -0,0 +1,264 @@
+import json
+import os
+import sqlite3
+import threading
+
+from googleapiclient.errors import HttpError
+
+from constants import MIRROR_PATH
+from util import parse_range
+
+# Bumped whenever the tables change; older mirrors are dropped and refilled
+MIRROR_SCHEMA_VERSION = 2
+
+
+class SheetMirror:
+    # Local copy of ranges of one spreadsheet, served instead of the sheet
+    # while the spreadsheet's Drive version says nothing has changed.
+    # Ranges of derived sheets hold formulas, which any write may change, so
+    # they are fetched again after every write. Every action walks all the
+    # rows of the ranges it reads, so rows are kept by position only, with
+    # no index by Andrew ID or email
+    def __init__(self, client, spreadsheet_id, derived=()):
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+        self.derived = set(derived)
+        self.version = None
+        # How many writes the client had made when the version was read
+        self.writes = 0
+        self.available = True
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(MIRROR_PATH), exist_ok=True)
+        self.db = sqlite3.connect(MIRROR_PATH, check_same_thread=False)
+        with self.db:
+            (schema_version,) = self.db.execute("PRAGMA user_version").fetchone()
+            if schema_version != MIRROR_SCHEMA_VERSION:
+                self.db.executescript(f"""
+                    DROP TABLE IF EXISTS ranges;
+                    DROP TABLE IF EXISTS rows;
+                    PRAGMA user_version = {MIRROR_SCHEMA_VERSION};
+                    """)
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS ranges (
+                    spreadsheet_id TEXT,
+                    sheet_range TEXT,
+                    version TEXT,
+                    PRIMARY KEY (spreadsheet_id, sheet_range)
+                );
+                CREATE TABLE IF NOT EXISTS rows (
+                    spreadsheet_id TEXT,
+                    sheet_range TEXT,
+                    row INTEGER,
+                    record TEXT,
+                    PRIMARY KEY (spreadsheet_id, sheet_range, row)
+                );
+                """)
+
+    def __get_range_version(self, sheet_range):
+        row = self.db.execute(
+            "SELECT version FROM ranges WHERE spreadsheet_id = ? AND sheet_range = ?",
+            (self.spreadsheet_id, sheet_range),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def __store(self, sheet_range, rows, version):
+        # Replace every row, or update and append the given ones when rows
+        # maps row indices to records
+        if isinstance(rows, list):
+            self.db.execute(
+                "DELETE FROM rows WHERE spreadsheet_id = ? AND sheet_range = ?",
+                (self.spreadsheet_id, sheet_range),
+            )
+            rows = dict(enumerate(rows))
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)",
+            [
+                (
+                    self.spreadsheet_id,
+                    sheet_range,
+                    i,
+                    json.dumps(record, separators=(",", ":")),
+                )
+                for i, record in rows.items()
+            ],
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO ranges VALUES (?, ?, ?)",
+            (self.spreadsheet_id, sheet_range, version),
+        )
+
+    def __get_rows(self, sheet_range):
+        return [
+            json.loads(record)
+            for (record,) in self.db.execute(
+                "SELECT record FROM rows WHERE spreadsheet_id = ? AND sheet_range = ? "
+                "ORDER BY row",
+                (self.spreadsheet_id, sheet_range),
+            )
+        ]
+
+    def refresh_version(self):
+        # Without a version to check against, every read goes to the sheet
+        if not self.available:
+            return None
+
+        # Counted first, so a write landing in between looks like someone
+        # else's edit rather than hiding one
+        writes = self.client.get_write_count(self.spreadsheet_id)
+        try:
+            self.version = self.client.get_file_version(self.spreadsheet_id)
+            self.writes = writes
+        except HttpError as e:
+            # Logins that declined the Drive metadata scope, or spreadsheets
+            # not shared with the user, only allow reading the sheet itself
+            if e.resp.status not in (403, 404):
+                raise
+            print("[INFO] Cannot read the gradecard's version, not mirroring it")
+            self.available = False
+            self.version = None
+        return self.version
+
+    def is_current(self, sheet_range):
+        with self.lock:
+            version = self.refresh_version()
+            return version is not None and (
+                self.__get_range_version(sheet_range) == version
+            )
+
+    def get_values(self, sheet_range):
+        with self.lock:
+            version = self.refresh_version()
+            if version is not None and self.__get_range_version(sheet_range) == version:
+                return self.__get_rows(sheet_range)
+
+            values = self.client.get_values_from_sheet(
+                sheet_range=sheet_range, spreadsheet_id=self.spreadsheet_id
+            )
+            if version is not None:
+                with self.db:
+                    self.__store(sheet_range, values, version)
+            return values
+
+    def get_batch_values(self, sheet_ranges):
+        # Like get_values for many ranges, fetching the stale ones together
+        with self.lock:
+            version = self.refresh_version()
+            stale = [
+                sheet_range
+                for sheet_range in sheet_ranges
+                if version is None or self.__get_range_version(sheet_range) != version
+            ]
+
+            fetched = {}
+            if stale:
+                fetched = dict(
+                    zip(
+                        stale,
+                        self.client.batch_get_values_from_sheet(
+                            sheet_ranges=stale, spreadsheet_id=self.spreadsheet_id
+                        ),
+                    )
+                )
+                if version is not None:
+                    with self.db:
+                        for sheet_range, values in fetched.items():
+                            self.__store(sheet_range, values, version)
+
+            return [
+                (
+                    fetched[sheet_range]
+                    if sheet_range in fetched
+                    else self.__get_rows(sheet_range)
+                )
+                for sheet_range in sheet_ranges
+            ]
+
+    def get_projected_values(self, projection, sheet_name, first_row):
+        # Mirrored counterpart of GoogleCloudClient.get_projected_values_from_sheet.
+        # Each range is mirrored on its own, so writes still carry over to it
+        sheet_ranges = projection.get_ranges(sheet_name, first_row)
+        return projection.join(self.get_batch_values(sheet_ranges))
+
+    def commit(self, value_ranges=()):
+        # Called after this process writes to the spreadsheet. Ranges that
+        # were current carry the written values over to the new version, as
+        # long as every version since is one of this client's writes; anything
+        # else is fetched again when next read
+        with self.lock:
+            previous, previous_writes = self.version, self.writes
+            version = self.refresh_version()
+            if previous is None or version is None:
+                return
+            if int(version) != int(previous) + self.writes - previous_writes:
+                return
+
+            ranges = [
+                sheet_range
+                for (sheet_range,) in self.db.execute(
+                    "SELECT sheet_range FROM ranges WHERE spreadsheet_id = ? AND "
+                    "version = ?",
+                    (self.spreadsheet_id, previous),
+                )
+            ]
+
+            with self.db:
+                for sheet_range in ranges:
+                    sheet = parse_range(sheet_range)[0]
+                    if sheet in self.derived:
+                        continue
+
+                    self.__store(
+                        sheet_range,
+                        self.__apply(sheet_range, value_ranges),
+                        version,
+                    )
+
+    def __apply(self, sheet_range, value_ranges):
+        # Rows of a mirrored range changed by the written value ranges,
+        # with trailing empty cells dropped like Sheets does
+        sheet, first_row, first_column, last_row, last_column = parse_range(sheet_range)
+        changed = {}
+
+        for written_range, values in value_ranges:
+            written_sheet, row, column, _, _ = parse_range(written_range)
+            if written_sheet != sheet:
+                continue
+
+            for i, written in enumerate(values):
+                index = row + i - first_row
+                if index < 0 or last_row is not None and row + i > last_row:
+                    continue
+                if index not in changed:
+                    changed[index] = self.__get_row(sheet_range, index)
+
+                record = changed[index]
+                for j, value in enumerate(written):
+                    k = column + j - first_column
+                    if k < 0 or last_column is not None and column + j > last_column:
+                        continue
+                    while len(record) <= k:
+                        record.append("")
+                    record[k] = "" if value is None else str(value)
+                while record and record[-1] == "":
+                    record.pop()
+
+        # Rows appended past the end leave no gaps behind them
+        if changed:
+            (count,) = self.db.execute(
+                "SELECT COUNT(*) FROM rows WHERE spreadsheet_id = ? AND sheet_range = ?",
+                (self.spreadsheet_id, sheet_range),
+            ).fetchone()
+            for index in range(count, max(changed)):
+                changed.setdefault(index, [])
+
+        return changed
+
+    def __get_row(self, sheet_range, index):
+        row = self.db.execute(
+            "SELECT record FROM rows WHERE spreadsheet_id = ? AND sheet_range = ? "
+            "AND row = ?",
+            (self.spreadsheet_id, sheet_range, index),
+        ).fetchone()
+        return [] if row is None else json.loads(row[0])
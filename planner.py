@@ -0,0 +1,430 @@
+import itertools
+import math
+import os
+import time
+from collections import Counter
+
+from constants import (
+    ROSTER_SHEET_NAME,
+    ROSTER_SHEET_RANGE_W,
+    EXPORT_SHEET_NAME,
+    EXPORT_FIRST_ROW,
+    EXPORT_SHEET_RANGE_HEADER,
+    DATA_SHEET_NAME,
+    CARD_VIEWS,
+    VALUE_RANGES_PER_REQUEST,
+    SYNC_BATCH_SIZE,
+    BATCH_SIZE,
+    EXPORT_FLUSH_SIZE,
+    CHECKPOINT_FLUSH_SIZE,
+    GRADESCOPE_CATALOG_TTL,
+    GRADESCOPE_EVALUATIONS_TTL,
+    GRADESCOPE_FINAL_AFTER,
+    SHEETS_READS_PER_MINUTE,
+    SHEETS_WRITES_PER_MINUTE,
+    DRIVE_REQUESTS_PER_MINUTE,
+    UPLOAD_CHUNK_BYTES,
+)
+from cache import GradescopeCache
+from ratelimit import get_bucket_name
+from resource import open_roster
+from secrets import BASE_STUDENT_SPREADSHEET_ID, GRADESCOPE_COURSE_ID
+from service import (
+    ROSTER_SCHEMA,
+    EXPORT_SCHEMA,
+    EXPORT_PROJECTION,
+    GoogleCloudService,
+    GradescopeService,
+)
+from util import chunk_rows, get_entry
+
+QUOTAS = {
+    "sheets.read": SHEETS_READS_PER_MINUTE,
+    "sheets.write": SHEETS_WRITES_PER_MINUTE,
+    "drive": DRIVE_REQUESTS_PER_MINUTE,
+}
+
+
+class Plan:
+    # The API calls an action would make, in total and per student
+    def __init__(self, action):
+        self.action = action
+        self.calls = Counter()
+        self.students = {}
+        self.notes = []
+
+    def add(self, method_id, count=1, student=None):
+        if count <= 0:
+            return
+
+        self.calls[method_id] += count
+        if student is not None:
+            self.students.setdefault(student, Counter())[method_id] += count
+
+    def note(self, message):
+        self.notes.append(message)
+
+    def get_duration(self):
+        # Every bucket starts with a full minute of tokens, and refills at
+        # its per-minute quota after that
+        calls = Counter()
+        for method_id, count in self.calls.items():
+            if not method_id.startswith("gradescope."):
+                calls[get_bucket_name(method_id)] += count
+
+        durations = {
+            bucket: max(0, count - QUOTAS[bucket]) * 60 / QUOTAS[bucket]
+            for bucket, count in calls.items()
+        }
+        return durations, calls
+
+    def print(self):
+        print(f"[INFO] Plan for {self.action} (dry run, nothing was written)")
+        for message in self.notes:
+            print(f"[INFO] {message}")
+
+        if not self.calls:
+            print("[INFO] No API calls would be made")
+            return
+
+        print(f"{'calls':>8}  {'quota':<13} method")
+        for method_id, count in sorted(self.calls.items()):
+            bucket = (
+                "gradescope"
+                if method_id.startswith("gradescope.")
+                else get_bucket_name(method_id)
+            )
+            print(f"{count:>8}  {bucket:<13} {method_id}")
+
+        # Group students that would get the same calls
+        if self.students:
+            groups = Counter()
+            examples = {}
+            for andrew_id, calls in self.students.items():
+                key = tuple(sorted(calls.items()))
+                groups[key] += 1
+                examples.setdefault(key, []).append(andrew_id)
+
+            print(f"[INFO] Operations per student, for {len(self.students)} students:")
+            for key, count in groups.most_common():
+                calls = ", ".join(f"{n} {method_id}" for method_id, n in key)
+                shown = ", ".join(examples[key][:3])
+                more = "" if count <= 3 else ", ..."
+                print(f"{count:>8}  x {calls} ({shown}{more})")
+
+        durations, calls = self.get_duration()
+        if not durations:
+            return
+
+        bucket = max(durations, key=durations.get)
+        print(
+            f"[INFO] At least {format_duration(durations[bucket])} under the "
+            f"configured quota ({calls[bucket]} {bucket} calls at "
+            f"{QUOTAS[bucket]}/min)"
+        )
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(math.ceil(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m {seconds}s"
+    return f"{seconds}s"
+
+
+class Planner:
+    # Mirrors the resources' actions, reading the gradecard once and
+    # counting the calls each action would make instead of making them
+    def __init__(self):
+        self.service = GoogleCloudService()
+        self.client = self.service.client
+        self.spreadsheet_id = self.service.spreadsheet_id
+        self.values = {}
+
+    def __read(self, plan, sheet_range):
+        # Ranges are read once per planner, into the local mirror, so the
+        # action only checks the spreadsheet's version before using them
+        if sheet_range not in self.values:
+            mirror = self.service.mirror
+            if not mirror.is_current(sheet_range) and mirror.available:
+                plan.note(f"{sheet_range} was read into the local mirror")
+            self.values[sheet_range] = self.service.mirror.get_values(sheet_range)
+        self.__plan_mirror_read(plan, "sheets.spreadsheets.values.get")
+        return self.values[sheet_range]
+
+    def __read_export(self, plan, projection=EXPORT_PROJECTION):
+        # The projected columns' ranges are read together in one batch
+        sheet_ranges = projection.get_ranges(EXPORT_SHEET_NAME, EXPORT_FIRST_ROW)
+        key = tuple(sheet_ranges)
+        if key not in self.values:
+            for sheet_range in sheet_ranges:
+                mirror = self.service.mirror
+                if not mirror.is_current(sheet_range) and mirror.available:
+                    plan.note(f"{sheet_range} was read into the local mirror")
+            self.values[key] = self.service.get_export_values(projection)
+        self.__plan_mirror_read(plan, "sheets.spreadsheets.values.batchGet")
+        return self.values[key]
+
+    def __plan_mirror_read(self, plan, method_id):
+        # Without the spreadsheet's version, nothing is mirrored and every
+        # read goes to the sheet
+        if self.service.mirror.available:
+            plan.add("drive.files.get")
+        else:
+            plan.add(method_id)
+
+    def __plan_commit(self, plan, count=1):
+        # The mirror checks the spreadsheet's version after every write
+        if self.service.mirror.available:
+            plan.add("drive.files.get", count)
+
+    def __plan_sheet(self, plan, sheet_name):
+        plan.add("sheets.spreadsheets.get")
+        if "sheets" not in self.values:
+            self.values["sheets"] = self.client.get_sheets_from_spreadsheet(
+                spreadsheet_id=self.spreadsheet_id
+            )
+        if sheet_name not in self.values["sheets"]:
+            plan.note(f"The {sheet_name} sheet would be created")
+            plan.add("sheets.spreadsheets.batchUpdate")
+            plan.add("sheets.spreadsheets.values.update")
+
+    def __plan_checkpoint(self, plan, num_students):
+        flushes = math.ceil(num_students / CHECKPOINT_FLUSH_SIZE)
+        plan.add("sheets.spreadsheets.values.batchUpdate", flushes)
+        self.__plan_commit(plan, flushes)
+
+    def __get_selection(self, action, students, resume):
+        permitlist, onwards_andrew_id = students or (None, None)
+        done = {}
+        if resume:
+            interrupted = self.service.get_interrupted_run(action)
+            if interrupted is not None:
+                options, done = interrupted
+                return options, done
+
+        return {"permitlist": permitlist, "onwards_andrew_id": onwards_andrew_id}, done
+
+    def post_add_new_students(self, roster):
+        plan = Plan("Add students")
+        self.__plan_sheet(plan, ROSTER_SHEET_NAME)
+        values = self.__read(plan, ROSTER_SHEET_RANGE_W)
+
+        with open_roster(roster) as students:
+            value_ranges, _, changes = self.service.diff_roster(values, students)
+
+        for andrew_id, change in changes.items():
+            if change != "unchanged":
+                plan.students[andrew_id] = Counter({f"roster row {change}": 1})
+        if value_ranges:
+            plan.add(
+                "sheets.spreadsheets.values.batchUpdate",
+                math.ceil(len(value_ranges) / VALUE_RANGES_PER_REQUEST),
+            )
+            self.__plan_commit(plan)
+
+        report = Counter(changes.values())
+        plan.note(
+            f"Roster: {report['added']} added, {report['changed']} changed, "
+            f"{report['dropped']} dropped, {report['unchanged']} unchanged"
+        )
+        return plan
+
+    def post_create_cards(self):
+        plan = Plan("Create cards")
+        self.__plan_sheet(plan, EXPORT_SHEET_NAME)
+        values = self.__read_export(plan)
+        roster = self.__read(plan, ROSTER_SHEET_RANGE_W)
+
+        andrew_ids = {
+            get_entry(record, "andrew_id", EXPORT_SCHEMA) for record in values
+        }
+        new_students = []
+        for student in roster:
+            andrew_id = get_entry(student, "Andrew ID", ROSTER_SCHEMA)
+            if andrew_id not in andrew_ids:
+                andrew_ids.add(andrew_id)
+                new_students.append(andrew_id)
+
+        # A student card is created, moved to its folder and shared
+        for andrew_id in new_students:
+            plan.add("sheets.spreadsheets.create", student=andrew_id)
+            plan.add("drive.files.get", student=andrew_id)
+            plan.add("drive.files.update", student=andrew_id)
+            plan.add("drive.permissions.create", student=andrew_id)
+        if new_students:
+            plan.add(
+                "sheets.spreadsheets.values.update",
+                math.ceil(len(new_students) / EXPORT_FLUSH_SIZE),
+            )
+            self.__plan_commit(plan)
+
+        plan.note(
+            f"{len(new_students)} new students would get cards; export rows are "
+            "written back in at most the planned number of updates"
+        )
+        return plan
+
+    def post_update_card_views(self, views=None, students=None, resume=False):
+        plan = Plan("Update views")
+        values = self.__read_export(plan)
+        options, done = self.__get_selection("update_views", students, resume)
+        views = options.get("views", views) or CARD_VIEWS
+
+        if BASE_STUDENT_SPREADSHEET_ID not in self.client.sheet_id_cache:
+            plan.add("sheets.spreadsheets.get")
+
+        num_students = 0
+        for _, record, andrew_id in self.service.select_students(
+            values, options["permitlist"], options["onwards_andrew_id"], done
+        ):
+            num_students += 1
+            plan.add("sheets.spreadsheets.sheets.copyTo", len(views), andrew_id)
+            plan.add("sheets.spreadsheets.batchUpdate", student=andrew_id)
+
+            # Cards without a remembered layout are looked up first
+            ssid = get_entry(record, "ssid", EXPORT_SCHEMA)
+            if self.client.card_layouts.get(ssid) is None:
+                plan.add("sheets.spreadsheets.get", student=andrew_id)
+        self.__plan_checkpoint(plan, num_students)
+
+        plan.note(f"{len(views)} views would be updated for {num_students} students")
+        if done:
+            plan.note(f"{len(done)} students finished by the interrupted run")
+        return plan
+
+    def post_update_card_data(self, students=None, resume=False, full=False):
+        plan = Plan("Sync data")
+        self.__read(plan, EXPORT_SHEET_RANGE_HEADER)
+        variables, public_projection, projection = self.service.get_card_variables(
+            ["student"]
+        )
+        values = self.__read_export(plan, projection)
+        options, done = self.__get_selection("sync_data", students, resume)
+
+        written = []
+        skipped = 0
+        for _, record, andrew_id in self.service.select_students(
+            values, options["permitlist"], options["onwards_andrew_id"], done
+        ):
+            writes = self.service.get_card_writes(
+                record, variables, public_projection, ["student"], not full
+            )
+            if not writes:
+                skipped += 1
+                continue
+
+            written.append(andrew_id)
+            for ssid in writes:
+                # Cards whose last write is unknown are cleared first
+                key = f"{ssid}/{DATA_SHEET_NAME}"
+                if self.client.sheet_extents.get(key) is None:
+                    plan.add("sheets.spreadsheets.values.clear", student=andrew_id)
+                plan.add("sheets.spreadsheets.values.update", student=andrew_id)
+        self.__plan_checkpoint(plan, len(written))
+
+        # Writes go out in HTTP batches of at most BATCH_SIZE per flush
+        batches = 0
+        for i in range(0, len(written), SYNC_BATCH_SIZE):
+            batches += math.ceil(len(written[i : i + SYNC_BATCH_SIZE]) / BATCH_SIZE)
+        plan.note(
+            f"{len(written)} students would be written in about {batches} HTTP "
+            f"batches per call type, {skipped} are unchanged"
+        )
+        return plan
+
+    def post_load_data(self, configs=None, load_all_data=False):
+        plan = Plan("Load Gradescope data")
+        current = time.time()
+
+        # The course's assignments are fetched once, when the client starts
+        # with an expired catalog
+        meta = GradescopeCache(GRADESCOPE_COURSE_ID).get_assignments_meta()
+        if meta is None or current - meta["fetched_at"] >= GRADESCOPE_CATALOG_TTL:
+            plan.add("gradescope.get_course_assignments")
+
+        service = GradescopeService()
+        if configs is None:
+            configs = [config["value"] for config in service.get_configs()]
+
+        for config in configs:
+            try:
+                config_data = service.read_config(config)
+            except ValueError:
+                plan.note(f"{config} is malformed and would be skipped")
+                continue
+
+            # Evaluations are fetched again unless the cache can answer
+            assignments = {}
+            cached = True
+            for name in filter(None, (config_data.name, config_data.cyu)):
+                try:
+                    assignment = service.client.get_assignment_by_name(name)
+                except KeyError:
+                    plan.note(f"{name} was not found on Gradescope")
+                    continue
+
+                assignments[name] = assignment
+                meta = service.client.get_evaluation_meta(assignment["id"])
+                if (
+                    meta is None
+                    or current - meta["fetched_at"] >= GRADESCOPE_EVALUATIONS_TTL
+                    and (
+                        meta.get("final_since") is None
+                        or current - meta["final_since"] < GRADESCOPE_FINAL_AFTER
+                    )
+                ):
+                    plan.add("gradescope.get_assignment_evaluations")
+                    cached = False
+
+            # A staging sheet is added, filled chunk by chunk and swapped in
+            plan.add("sheets.spreadsheets.get")
+            plan.add("sheets.spreadsheets.batchUpdate", 2)
+            plan.add(
+                "sheets.spreadsheets.values.update",
+                self.__count_chunks(plan, service, config_data, assignments, cached),
+            )
+            self.__plan_commit(plan)
+
+        plan.note(f"{len(configs)} configs would be loaded")
+        return plan
+
+    def __count_chunks(self, plan, service, config_data, assignments, cached):
+        # The rows to upload are only known once the evaluations are at hand
+        if not cached:
+            plan.note(
+                f"{config_data.gsheet_name} is counted as one upload chunk, "
+                "as its evaluations are not cached"
+            )
+            return 1
+
+        assignment_data = service.get_assignment_evaluations(
+            config_data, assignments.get(config_data.name)
+        )
+        cyu_data = (
+            service.get_cyu_evaluations(assignments.get(config_data.cyu))
+            if config_data.cyu
+            else {}
+        )
+        rows = itertools.chain(
+            [list(config_data.columns)],
+            service.generate_upload_rows(
+                assignment_data, config_data.num_questions, cyu_data
+            ),
+        )
+        return sum(1 for _ in chunk_rows(rows, UPLOAD_CHUNK_BYTES))
+
+    def post_clear_cache(self, configs=None, clear_all=False):
+        plan = Plan("Clear Gradescope cache")
+        service = GradescopeService()
+        path = service.client.cache.path
+        entries = os.listdir(path) if os.path.isdir(path) else []
+        if configs is None:
+            plan.note(f"{len(entries)} cached Gradescope entries would be removed")
+        else:
+            plan.note(
+                f"Cached Gradescope data for {len(configs)} configs would be removed"
+            )
+        return plan
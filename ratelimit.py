@@ -0,0 +1,112 @@
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from constants import (
+    SHEETS_READS_PER_MINUTE,
+    SHEETS_WRITES_PER_MINUTE,
+    DRIVE_REQUESTS_PER_MINUTE,
+    RETRYABLE_STATUS_CODES,
+    NON_IDEMPOTENT_METHODS,
+    RATE_LIMITED_STATUS_CODE,
+    MAX_ATTEMPTS,
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+)
+from metrics import get_payload_bytes, get_resource, track
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute):
+        self.rate = requests_per_minute / 60
+        self.capacity = requests_per_minute
+        self.tokens = requests_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+
+        while True:
+            with self.lock:
+                current = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (current - self.updated) * self.rate
+                )
+                self.updated = current
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# Shared by every client in the process, since quotas are per user
+BUCKETS = {
+    "sheets.read": TokenBucket(SHEETS_READS_PER_MINUTE),
+    "sheets.write": TokenBucket(SHEETS_WRITES_PER_MINUTE),
+    "drive": TokenBucket(DRIVE_REQUESTS_PER_MINUTE),
+}
+
+
+def get_bucket_name(method_id):
+    api, _, method = method_id.partition(".")
+    if api == "sheets":
+        if method.endswith(".get") or method.endswith(".batchGet"):
+            return "sheets.read"
+        return "sheets.write"
+    return "drive"
+
+
+def get_bucket(request):
+    return BUCKETS[get_bucket_name(request.methodId)]
+
+
+def is_retryable(error, method_id=None):
+    if method_id in NON_IDEMPOTENT_METHODS:
+        return (
+            isinstance(error, HttpError)
+            and error.resp.status == RATE_LIMITED_STATUS_CODE
+        )
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def get_backoff(attempt, error=None):
+    # Honor the server's Retry-After header, otherwise back off exponentially
+    # with jitter so that parallel workers do not retry in lockstep
+    if isinstance(error, HttpError):
+        retry_after = error.resp.get("retry-after", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def execute(request):
+    bucket = get_bucket(request)
+    resource = get_resource(request.methodId)
+    payload_bytes = get_payload_bytes(request)
+
+    for attempt in range(MAX_ATTEMPTS):
+        bucket.acquire()
+        try:
+            with track(resource, request.methodId, payload_bytes, attempt > 0):
+                return request.execute()
+        except (HttpError, ConnectionError, TimeoutError) as e:
+            if not is_retryable(e, request.methodId) or attempt + 1 == MAX_ATTEMPTS:
+                raise
+
+            delay = get_backoff(attempt, e)
+            print(
+                f"[ERROR] {request.methodId} failed ({e.__class__.__name__}), "
+                f"retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
@@ -1,51 +1,98 @@
 import csv
+import gzip
+from contextlib import contextmanager
 
-from cli import prompt_roster, prompt_views, prompt_students, prompt_configs
+from cli import (
+    prompt_roster,
+    prompt_views,
+    prompt_students,
+    prompt_configs,
+    prompt_resume,
+)
 from service import GoogleCloudService, GradescopeService
 
 
+@contextmanager
+def open_roster(roster_path):
+    # Registrar exports may be gzipped; either way rows are streamed
+    opener = gzip.open if roster_path.endswith(".gz") else open
+    with opener(roster_path, "rt", newline="") as f:
+        roster = csv.reader(f)
+        next(roster)  # ignore header
+        yield roster
+
+
 class GoogleCloudResource:
     def __init__(self):
         self.service = GoogleCloudService()
 
-    def post_add_new_students(self):
-        try:
-            roster_path = prompt_roster()
-        except IndexError:
-            raise FileNotFoundError("No CSV Rosters Found") from None
+    def post_add_new_students(self, roster=None):
+        roster_path = roster
+        if roster_path is None:
+            try:
+                roster_path = prompt_roster()
+            except IndexError:
+                raise FileNotFoundError("No CSV Rosters Found") from None
 
-        with open(roster_path) as f:
-            roster = csv.reader(f)
-            next(roster)  # ignore header
+        with open_roster(roster_path) as roster:
             self.service.add_students(roster)
 
     def post_create_cards(self):
         agents = ["student"]
         self.service.create_cards(agents)
 
-    def post_update_card_data(self):
+    def __prompt_resume(self, action):
+        interrupted = self.service.get_interrupted_run(action)
+        if interrupted is None:
+            return False
+
+        _, done = interrupted
+        return prompt_resume(len(done))
+
+    def post_update_card_data(self, students=None, resume=None, full=False):
         agents = ["student"]
-        students, onwards = prompt_students()
-        self.service.sync_data(agents, students, onwards)
+        if resume is None:
+            resume = self.__prompt_resume("sync_data")
+        # A resumed run reuses the interrupted run's students
+        if not resume:
+            students = students or prompt_students()
+        students, onwards = students or (None, None)
+        self.service.sync_data(
+            agents, students, onwards, incremental=not full, resume=resume
+        )
 
-    def post_update_card_views(self):
-        views = prompt_views()
+    def post_update_card_views(self, views=None, students=None, resume=None):
         agents = ["student"]
-        students, onwards = prompt_students()
-        self.service.update_views(views, agents, students, onwards)
+        if resume is None:
+            resume = self.__prompt_resume("update_views")
+        # A resumed run reuses the interrupted run's views and students
+        if not resume:
+            views = views or prompt_views()
+            students = students or prompt_students()
+        students, onwards = students or (None, None)
+        self.service.update_views(views, agents, students, onwards, resume=resume)
 
 
 class GradescopeResource:
     def __init__(self):
         self.service = GradescopeService()
 
-    def post_load_data(self, load_all_data=False):
+    def post_load_data(self, configs=None, load_all_data=False):
         all_configs = self.service.get_configs()
 
         if len(all_configs) == 0:
             raise FileNotFoundError("No Homework Configs Found") from None
 
-        if not load_all_data:
+        if configs is None and load_all_data:
+            configs = [config["value"] for config in all_configs]
+        elif configs is None:
             configs = prompt_configs(all_configs)
-        for config in configs:
-            self.service.load_data_from_config(config)
+        self.service.load_data_from_configs(configs)
+
+    def post_clear_cache(self, configs=None, clear_all=False):
+        if configs is None and not clear_all:
+            configs = prompt_configs(
+                self.service.get_configs(),
+                "Which assignments' cached data do you want to clear? (none for all)",
+            )
+        self.service.clear_cache(configs or None)
@@ -0,0 +1,190 @@
+import numpy as np
+
+from constants import STAR_THRESHOLD
+
+
+def get_question_names_for_question(question, all_question_names):
+    data = []
+
+    for q in all_question_names:
+        try:
+            colon = q.index(":")
+            paren = q.index("(")
+        except ValueError:
+            continue
+
+        if q[colon + 1 : paren].strip().startswith(question):
+            data.append(q)
+
+    if len(data) == 0:
+        raise KeyError("No Matching Question Found")
+
+    return data
+
+
+def get_grader_columns(rubric_items):
+    # Rubric items named like "Grader (AB)" mark which TA graded a question
+    columns = []
+    for key in rubric_items:
+        if not key.startswith("Grader"):
+            continue
+        try:
+            paren = key.index("(")
+        except ValueError:
+            continue
+
+        columns.append((key, key[paren + 1 : paren + 3]))
+
+    return columns
+
+
+class ScoringPlan:
+    def __init__(self, config_data, sample_evaluation):
+        # Resolve every configured question to column indices into the list
+        # of Gradescope questions this assignment actually uses
+        self.questions = []
+        self.question_names = []
+        self.grader_columns = []
+
+        all_question_names = list(sample_evaluation["questions"])
+        map_question_name_to_index = {}
+        map_prefix_to_indices = {}
+
+        for prefix in config_data.question_prefixes:
+            indices = []
+            for name in get_question_names_for_question(prefix, all_question_names):
+                if name not in map_question_name_to_index:
+                    map_question_name_to_index[name] = len(self.question_names)
+                    self.question_names.append(name)
+                    self.grader_columns.append(
+                        get_grader_columns(
+                            sample_evaluation["questions"][name]["rubric_items"]
+                        )
+                    )
+                indices.append(map_question_name_to_index[name])
+            map_prefix_to_indices[prefix] = indices
+
+        for slot in config_data.questions:
+            if slot is None:
+                self.questions.append(None)
+                continue
+
+            star_indices = (
+                map_prefix_to_indices[slot.star_name] if slot.star_name else None
+            )
+            self.questions.append(
+                (slot, map_prefix_to_indices[slot.name], star_indices)
+            )
+
+    def project(self, evaluation):
+        # Keep only what scoring needs from a submission: the score, comment
+        # and graders of each planned question
+        answers = [evaluation["questions"][name] for name in self.question_names]
+        return (
+            evaluation["Email"],
+            evaluation["Submission Time"],
+            [answer["score"] for answer in answers],
+            [answer["comment"] for answer in answers],
+            [
+                [bool(answers[j]["rubric_items"].get(key)) for key, _ in columns]
+                for j, columns in enumerate(self.grader_columns)
+            ],
+        )
+
+    def score(self, evaluation_data):
+        # Submissions are projected as they stream in, so the full export is
+        # never held in memory
+        projected = [
+            self.project(evaluation)
+            for evaluation in evaluation_data
+            if evaluation["Status"] == "Graded"
+        ]
+        if not projected:
+            return {}
+
+        emails, submission_times, scores, comments, graders = zip(*projected)
+        del projected
+
+        # Gather every submission into submission x question arrays
+        shape = (len(emails), len(self.question_names))
+        scores = np.array(scores, dtype=float).reshape(shape)
+        scores = np.round(scores * 100) / 100
+        comments = np.array(comments, dtype=object).reshape(shape)
+
+        # First grader rubric item applied to each answer, or "" if none was
+        tas = np.full(scores.shape, "", dtype=object)
+        for j, columns in enumerate(self.grader_columns):
+            if not columns:
+                continue
+
+            applied = np.array([row[j] for row in graders])
+            initials = np.array([ta for _, ta in columns], dtype=object)
+            tas[:, j] = np.where(
+                applied.any(axis=1), initials[applied.argmax(axis=1)], ""
+            )
+
+        def join(matrix, indices, skip_empty=False):
+            if len(indices) == 1:
+                return matrix[:, indices[0]].tolist()
+            if skip_empty:
+                return [";".join(filter(None, row)) for row in matrix[:, indices]]
+            return [";".join(row) for row in matrix[:, indices]]
+
+        def total(indices):
+            result = np.zeros(len(emails))
+            for i in indices:
+                result += scores[:, i]
+            return result
+
+        # Score every question for all submissions at once, taking the star
+        # question wherever the main question scored nothing but the star did
+        results = []
+        for question in self.questions:
+            if question is None:
+                results.append(None)
+                continue
+
+            slot, indices, star_indices = question
+            q_scores = total(indices)
+            q_tas = join(tas, indices, skip_empty=True)
+            q_comments = join(comments, indices)
+            star = np.zeros(len(emails), dtype=bool)
+
+            if star_indices is not None:
+                star_scores = total(star_indices)
+                star = (q_scores < STAR_THRESHOLD) & (star_scores >= STAR_THRESHOLD)
+                q_scores = np.where(star, star_scores, q_scores)
+
+                # Only join star text for the submissions that take the star
+                starred = np.flatnonzero(star)
+                if len(starred):
+                    star_tas = join(tas[starred], star_indices, skip_empty=True)
+                    star_comments = join(comments[starred], star_indices)
+                    for i, ta, comment in zip(starred, star_tas, star_comments):
+                        q_tas[i] = ta
+                        q_comments[i] = comment
+
+            results.append(
+                [
+                    {
+                        "score": score,
+                        "TA": ta,
+                        "comments": comment,
+                        "name": slot.star_name if is_star else slot.name,
+                        "star": is_star,
+                    }
+                    for score, ta, comment, is_star in zip(
+                        q_scores.tolist(), q_tas, q_comments, star.tolist()
+                    )
+                ]
+            )
+
+        return {
+            email: {
+                "Submission Time": submission_time,
+                "questions": [
+                    None if result is None else result[i] for result in results
+                ],
+            }
+            for i, (email, submission_time) in enumerate(zip(emails, submission_times))
+        }
@@ -1,23 +1,35 @@
-import configparser
-import csv
-import io
-import os
-
+from collections import Counter
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+import itertools
+import queue
+import threading
+import time
+
+from catalog import ConfigCatalog
 from cli import prompt_confirm_unpublished
 from client import GoogleCloudClient, GradescopeClient
+from mirror import SheetMirror
 from constants import (
     ROSTER_SHEET_NAME,
+    ROSTER_FIRST_ROW,
     ROSTER_SHEET_RANGE_W,
+    ROSTER_VOLATILE_COLUMNS,
     ROSTER_HEADER,
     EXPORT_SHEET_NAME,
+    EXPORT_FIRST_ROW,
     EXPORT_HEADER,
     EXPORT_SHEET_RANGE_R,
-    EXPORT_SHEET_RANGE_W,
     CARD_SHEETS,
     EXPORT_SHEET_RANGE_HEADER,
     DATA_SHEET_NAME,
-    CONFIG_PATH,
-    STAR_THRESHOLD,
+    SYNC_BATCH_SIZE,
+    CREATE_CARDS_WORKERS,
+    EXPORT_FLUSH_SIZE,
+    EXPORT_FLUSH_INTERVAL,
+    CHECKPOINT_FLUSH_SIZE,
+    CHECKPOINT_FLUSH_INTERVAL,
+    GRADESCOPE_FETCH_WORKERS,
+    PIPELINE_QUEUE_SIZE,
 )
 from secrets import (
     BASE_STUDENT_SPREADSHEET_ID,
@@ -27,22 +39,161 @@ from secrets import (
 )
 from util import (
     get_entry,
-    get_entries_across,
     get_entries,
     set_entry,
     set_entries_across,
     now,
     truncate_values,
     round_to_hundredths,
+    fingerprint,
+    format_cell,
+    get_column_letter,
+    get_cell,
+    cells_equal,
+    Schema,
 )
-# imports for catching http errors and starting again
+from state import Journal, get_state_store
 from googleapiclient.errors import HttpError
-from time import sleep
+
+ROSTER_SCHEMA = Schema(ROSTER_HEADER)
+EXPORT_SCHEMA = Schema(EXPORT_HEADER)
+# The export columns kept by this tool, the first ones of the sheet
+EXPORT_PROJECTION = EXPORT_SCHEMA.project(EXPORT_HEADER)
+
+
+class OrderedExportWriter:
+    def __init__(
+        self,
+        client,
+        spreadsheet_id,
+        values,
+        flush_size=EXPORT_FLUSH_SIZE,
+        flush_interval=EXPORT_FLUSH_INTERVAL,
+    ):
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+        self.values = values
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.next_index = 0
+        self.written = 0
+        self.completed = {}
+        self.buffer = []
+        self.flushed = time.monotonic()
+
+    def add(self, index, record):
+        # Records may finish out of order; hold them back until every earlier
+        # one has finished. Failed records are passed in as None
+        self.completed[index] = record
+        while self.next_index in self.completed:
+            record = self.completed.pop(self.next_index)
+            self.next_index += 1
+            if record is not None:
+                self.buffer.append(record)
+
+        if len(self.buffer) >= self.flush_size or (
+            self.buffer and time.monotonic() - self.flushed >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if not self.buffer:
+            return
+
+        # Write only the new rows, right below the ones already in the sheet
+        print("[INFO] Adding new cards IDs to spreadsheet")
+        first = len(self.values) + EXPORT_FIRST_ROW
+        last = first + len(self.buffer) - 1
+        column = get_column_letter(len(EXPORT_SCHEMA) - 1)
+        self.client.set_values_in_sheet(
+            sheet_range=f"{EXPORT_SHEET_NAME}!A{first}:{column}{last}",
+            spreadsheet_id=self.spreadsheet_id,
+            values=truncate_values(self.buffer, EXPORT_SCHEMA),
+        )
+        self.values.extend(self.buffer)
+        self.written += len(self.buffer)
+        self.buffer = []
+
+
+class ExportCheckpoint:
+    # Journals every finished student and writes their last_updated back to
+    # the export sheet every few students, so an interrupted run keeps its
+    # progress
+    def __init__(
+        self,
+        client,
+        spreadsheet_id,
+        values,
+        journal,
+        mirror,
+        flush_size=CHECKPOINT_FLUSH_SIZE,
+        flush_interval=CHECKPOINT_FLUSH_INTERVAL,
+    ):
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+        self.values = values
+        self.journal = journal
+        self.mirror = mirror
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.column = get_column_letter(EXPORT_SCHEMA.index("last_updated"))
+        self.dirty = []
+        self.flushed = time.monotonic()
+
+    def restore(self, index, last_updated):
+        # Students finished by the interrupted run may not have been written
+        set_entry(self.values[index], last_updated, "last_updated", EXPORT_SCHEMA)
+        self.dirty.append(index)
+
+    def done(self, index):
+        record = self.values[index]
+        last_updated = now()
+        set_entry(record, last_updated, "last_updated", EXPORT_SCHEMA)
+        self.journal.done(get_entry(record, "andrew_id", EXPORT_SCHEMA), last_updated)
+        self.dirty.append(index)
+
+        if (
+            len(self.dirty) >= self.flush_size
+            or time.monotonic() - self.flushed >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if not self.dirty:
+            return
+
+        # Write the last_updated cells of each run of consecutive finished
+        # students, leaving the rows in between untouched
+        value_ranges = []
+        indices = sorted(set(self.dirty))
+        for _, run in itertools.groupby(enumerate(indices), lambda p: p[1] - p[0]):
+            run = [i for (_, i) in run]
+            sheet_range = (
+                f"{EXPORT_SHEET_NAME}!{self.column}{run[0] + EXPORT_FIRST_ROW}:"
+                f"{self.column}{run[-1] + EXPORT_FIRST_ROW}"
+            )
+            values = [
+                [get_entry(self.values[i], "last_updated", EXPORT_SCHEMA)] for i in run
+            ]
+            value_ranges.append((sheet_range, values))
+
+        self.client.batch_update_values(self.spreadsheet_id, value_ranges)
+        self.mirror.commit(value_ranges)
+        self.journal.sync()
+        self.dirty = []
+
 
 class GoogleCloudService:
     def __init__(self):
         self.spreadsheet_id = GRADECARD_SPREADSHEET_ID
         self.client = GoogleCloudClient()
+        self.mirror = SheetMirror(
+            self.client, self.spreadsheet_id, derived=[EXPORT_SHEET_NAME]
+        )
+        self.fingerprints = get_state_store("card_fingerprints")
+        self.roster_fingerprints = get_state_store("roster_fingerprints")
 
     def add_students(self, roster):
         # Create roster sheet in spreadsheet, if it does not exist
@@ -57,29 +208,131 @@ class GoogleCloudService:
                 header=ROSTER_HEADER,
             )
 
-        # Get list of existing students
-        values = self.client.get_values_from_sheet(
-            sheet_range=ROSTER_SHEET_RANGE_W, spreadsheet_id=self.spreadsheet_id
+        values = self.mirror.get_values(ROSTER_SHEET_RANGE_W)
+        value_ranges, new_fingerprints, changes = self.diff_roster(values, roster)
+
+        if value_ranges:
+            print("[INFO] Updating students in spreadsheet")
+            self.client.batch_update_values(self.spreadsheet_id, value_ranges)
+            self.mirror.commit(value_ranges)
+
+        for andrew_id, change in changes.items():
+            if change in ("dropped", "gone"):
+                self.roster_fingerprints.delete(andrew_id)
+        for andrew_id, key in new_fingerprints.items():
+            self.roster_fingerprints.set(andrew_id, key)
+        self.roster_fingerprints.save()
+
+        report = Counter(changes.values())
+        print(
+            f"[INFO] Roster: {report['added']} added, {report['changed']} changed, "
+            f"{report['dropped']} dropped, {report['unchanged']} unchanged"
         )
-        andrew_ids = set(get_entries(values, "Andrew ID", ROSTER_HEADER))
 
-        # Get list of new students
+    def diff_roster(self, values, roster):
+        # Work out the writes that bring the roster sheet's values in line
+        # with the roster, and how each student changed: added, changed,
+        # unchanged, dropped, or gone if already marked as dropped
+        andrew_id_column = ROSTER_SCHEMA.index("Andrew ID")
+        dropped_on_column = ROSTER_SCHEMA.index("Dropped On")
+
+        # Index the students already in the roster sheet by Andrew ID
+        existing = {}
+        for i, record in enumerate(values):
+            andrew_id = get_cell(record, andrew_id_column)
+            if andrew_id:
+                existing.setdefault(andrew_id, (i, record))
+
+        # Stream the roster through the index, keeping only what differs
+        compared = [
+            i
+            for i, column in enumerate(ROSTER_SCHEMA)
+            if column not in ROSTER_VOLATILE_COLUMNS
+        ]
+        value_ranges = []
         new_students = []
+        new_fingerprints = {}
+        changes = {}
+
         for student in roster:
-            if get_entry(student, "Andrew ID", ROSTER_HEADER) not in andrew_ids:
-                new_students.append(list(student))
+            andrew_id = get_cell(student, andrew_id_column)
+            if not andrew_id or andrew_id in new_fingerprints:
+                continue
+
+            student = list(student)
+            new_fingerprints[andrew_id] = fingerprint(
+                [get_cell(student, i) for i in compared]
+            )
 
-        # Append new students to roster sheet
+            if andrew_id not in existing:
+                new_students.append(student)
+                changes[andrew_id] = "added"
+                continue
+
+            # Rows written from an identical roster row are not compared again
+            if self.roster_fingerprints.get(andrew_id) == new_fingerprints[andrew_id]:
+                changes[andrew_id] = "unchanged"
+                continue
+
+            i, record = existing[andrew_id]
+            changed = [
+                j
+                for j in compared
+                if not cells_equal(get_cell(student, j), get_cell(record, j))
+            ]
+            if not changed:
+                changes[andrew_id] = "unchanged"
+                continue
+
+            first, last = min(changed), max(changed)
+            value_ranges.append(
+                (
+                    self.__get_roster_range(i, first, last),
+                    [[get_cell(student, j) for j in range(first, last + 1)]],
+                )
+            )
+            changes[andrew_id] = "changed"
+
+        # Students missing from the roster have dropped the course
+        if new_fingerprints:
+            for andrew_id, (i, record) in existing.items():
+                if andrew_id in new_fingerprints:
+                    continue
+                if get_cell(record, dropped_on_column):
+                    changes[andrew_id] = "gone"
+                    continue
+
+                value_ranges.append(
+                    (
+                        self.__get_roster_range(
+                            i, dropped_on_column, dropped_on_column
+                        ),
+                        [[now()]],
+                    )
+                )
+                changes[andrew_id] = "dropped"
+        else:
+            print("[ERROR] Roster has no students, not marking anyone as dropped")
+
+        # Append new students below the last row of the roster sheet
         if new_students:
-            print("[INFO] Adding new students to spreadsheet")
-            values.extend(new_students)
-            self.client.set_values_in_sheet(
-                sheet_range=ROSTER_SHEET_RANGE_W,
-                spreadsheet_id=self.spreadsheet_id,
-                values=values,
+            value_ranges.append(
+                (
+                    f"{ROSTER_SHEET_NAME}!A{len(values) + ROSTER_FIRST_ROW}",
+                    new_students,
+                )
             )
 
-    def create_cards(self, agents):
+        return value_ranges, new_fingerprints, changes
+
+    def __get_roster_range(self, index, first_column, last_column):
+        row = index + ROSTER_FIRST_ROW
+        return (
+            f"{ROSTER_SHEET_NAME}!{get_column_letter(first_column)}{row}:"
+            f"{get_column_letter(last_column)}{row}"
+        )
+
+    def create_cards(self, agents, workers=CREATE_CARDS_WORKERS):
         # Create export sheet in spreadsheet, if it does not exist
         sheets = self.client.get_sheets_from_spreadsheet(
             spreadsheet_id=self.spreadsheet_id
@@ -93,467 +346,558 @@ class GoogleCloudService:
             )
 
         # Get list of students in export sheet
-        values = self.client.get_values_from_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_R, spreadsheet_id=self.spreadsheet_id
-        )
-        andrew_ids = set(get_entries(values, "andrew_id", EXPORT_HEADER))
+        values = self.get_export_values()
+        andrew_ids = set(get_entries(values, "andrew_id", EXPORT_SCHEMA))
 
         # Get list of students in roster sheet
-        roster = self.client.get_values_from_sheet(
-            sheet_range=ROSTER_SHEET_RANGE_W, spreadsheet_id=self.spreadsheet_id
-        )
+        roster = self.mirror.get_values(ROSTER_SHEET_RANGE_W)
 
         # Get list of new students
         new_students = []
         for student in roster:
             # Get fields from record
-            andrew_id = get_entry(student, "Andrew ID", ROSTER_HEADER)
-            email_id = get_entry(student, "Email", ROSTER_HEADER)
+            andrew_id = get_entry(student, "Andrew ID", ROSTER_SCHEMA)
+            email_id = get_entry(student, "Email", ROSTER_SCHEMA)
 
             if andrew_id not in andrew_ids:
-                entries_dict = {
-                    "andrew_id": andrew_id,
-                    "email": email_id,
-                    "last_updated": now(),
+                andrew_ids.add(andrew_id)
+                new_students.append((andrew_id, email_id))
+
+        # Create cards concurrently, writing records back in roster order so
+        # the export sheet only ever holds a prefix of the new students
+        writer = OrderedExportWriter(self.client, self.spreadsheet_id, values)
+        stopped = False
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(self.__create_card, andrew_id, email_id, agents): i
+                    for i, (andrew_id, email_id) in enumerate(new_students)
                 }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    andrew_id = new_students[i][0]
+                    try:
+                        record = future.result()
+                    except CancelledError:
+                        record = None
+                    except HttpError as e:
+                        print(f"[ERROR] Creating cards failed for {andrew_id}: {e}")
+                        record = None
+                    except Exception as e:
+                        # Anything else is unlikely to pass for the next card,
+                        # so stop starting new ones
+                        print(f"[ERROR] Creating cards failed for {andrew_id}: {e}")
+                        record = None
+                        if not stopped:
+                            stopped = True
+                            for pending in futures:
+                                pending.cancel()
+                    writer.add(i, record)
+        finally:
+            # Cards already created must reach the export sheet, or the next
+            # run creates them again
+            writer.flush()
+            self.client.sheet_extents.save()
+
+        if stopped:
+            print(
+                f"[ERROR] Stopped creating cards; {len(new_students) - writer.written} "
+                "students are left for the next run"
+            )
 
-                # Create student card
-                if "student" in agents:
-                    print(f"[INFO] Creating student card for {andrew_id}")
-                    ssid = self.client.create_new_spreadsheet(
-                        f"[15-251] Student Card ({andrew_id})",
-                        CARD_SHEETS,
-                        STUDENT_CARDS_FOLDER_ID,
-                        [email_id],
-                    )
-                    entries_dict["ssid"] = ssid
+        # Formulas fill in the new students' rows, so the export is read again
+        if writer.written:
+            self.mirror.commit()
 
-                # Create TA card
-                if "ta" in agents:
-                    print(f"[INFO] Creating TA card for {andrew_id}")
-                    _ssid = self.client.create_new_spreadsheet(
-                        andrew_id, CARD_SHEETS, TA_CARDS_FOLDER_ID
-                    )
-                    entries_dict["_ssid"] = _ssid
-
-                # Create new record
-                record = ["" for _ in EXPORT_HEADER]
-                set_entries_across(record, entries_dict, EXPORT_HEADER)
-                new_students.append(record)
-
-            if len(new_students) >= 5:
-                print("[INFO] Adding new cards IDs to spreadsheet")
-                values.extend(new_students)
-                self.client.set_values_in_sheet(
-                    sheet_range=EXPORT_SHEET_RANGE_W,
-                    spreadsheet_id=self.spreadsheet_id,
-                    values=truncate_values(values, EXPORT_HEADER),
-                )
-                new_students = []
+    def __create_card(self, andrew_id, email_id, agents):
+        entries_dict = {
+            "andrew_id": andrew_id,
+            "email": email_id,
+            "last_updated": now(),
+        }
 
-        if new_students:
-            print("[INFO] Adding new cards IDs to spreadsheet")
-            values.extend(new_students)
-            self.client.set_values_in_sheet(
-                sheet_range=EXPORT_SHEET_RANGE_W,
-                spreadsheet_id=self.spreadsheet_id,
-                values=truncate_values(values, EXPORT_HEADER),
+        # Create student card
+        if "student" in agents:
+            print(f"[INFO] Creating student card for {andrew_id}")
+            ssid = self.client.create_new_spreadsheet(
+                f"[15-251] Student Card ({andrew_id})",
+                CARD_SHEETS,
+                STUDENT_CARDS_FOLDER_ID,
+                [email_id],
             )
+            entries_dict["ssid"] = ssid
 
-    def update_views(self, views, agents, permitlist=None, onwards_andrew_id=None):
-        # Get list of students in export sheet
-        values = self.client.get_values_from_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_R, spreadsheet_id=self.spreadsheet_id
+        # Create TA card
+        if "ta" in agents:
+            print(f"[INFO] Creating TA card for {andrew_id}")
+            _ssid = self.client.create_new_spreadsheet(
+                andrew_id, CARD_SHEETS, TA_CARDS_FOLDER_ID
+            )
+            entries_dict["_ssid"] = _ssid
+
+        # Create new record
+        record = [""] * len(EXPORT_SCHEMA)
+        set_entries_across(record, entries_dict, EXPORT_SCHEMA)
+        return record
+
+    def get_interrupted_run(self, action):
+        return Journal(action).read()
+
+    def __start_checkpoint(self, action, values, options, resume):
+        # Start journaling this run, picking up the options and finished
+        # students of an interrupted run when resuming
+        journal = Journal(action)
+        interrupted = journal.read() if resume else None
+        done = {}
+
+        if interrupted is not None:
+            options, done = interrupted
+            print(f"[INFO] Resuming {action}, skipping {len(done)} finished students")
+        elif resume:
+            print(f"[INFO] No interrupted {action} run to resume")
+
+        journal.start(options, resume=interrupted is not None)
+        checkpoint = ExportCheckpoint(
+            self.client, self.spreadsheet_id, values, journal, self.mirror
         )
+        for i, record in enumerate(values):
+            andrew_id = get_entry(record, "andrew_id", EXPORT_SCHEMA)
+            if andrew_id in done:
+                checkpoint.restore(i, done[andrew_id])
 
-        onwards_flag = onwards_andrew_id is None
+        return checkpoint, options, done
 
-        for record in values:
-            andrew_id = get_entry(record, "andrew_id", EXPORT_HEADER)
+    def select_students(self, values, permitlist, onwards_andrew_id, done):
+        # Students of the export sheet an action should handle, in order
+        onwards_flag = onwards_andrew_id is None
+        for i, record in enumerate(values):
+            andrew_id = get_entry(record, "andrew_id", EXPORT_SCHEMA)
             onwards_flag = onwards_flag or andrew_id == onwards_andrew_id
             if permitlist is not None and andrew_id not in permitlist:
                 continue
-            if not onwards_flag:
+            if not onwards_flag or andrew_id in done:
                 continue
 
-            # Update student card view
-            if "student" in agents:
-                print(f"[INFO] Updating student view for {andrew_id}")
-                ssid = get_entry(record, "ssid", EXPORT_HEADER)
-                while True:
-                    try:
-                        self.client.copy_sheets_to_spreadsheet(
-                            BASE_STUDENT_SPREADSHEET_ID, views, ssid, views
-                        )
-                        break
-                    except HttpError:
-                        print("[ERROR] Caught HttpError (likely rate-limit), waiting for 10s")
-                        sleep(10)
-
-
-
-            # Update TA card view
-            if "ta" in agents:
-                print(f"[INFO] Updating TA view for {andrew_id}")
-                _ssid = get_entry(record, "_ssid", EXPORT_HEADER)
-                self.client.copy_sheets_to_spreadsheet(
-                    BASE_STUDENT_SPREADSHEET_ID, views, _ssid, views
-                )
+            yield i, record, andrew_id
 
-            set_entry(record, now(), "last_updated", EXPORT_HEADER)
+    def get_export_values(self, projection=EXPORT_PROJECTION):
+        # Read only the projected columns of the export sheet, or every column
+        # without a projection
+        if projection is None:
+            return self.mirror.get_values(EXPORT_SHEET_RANGE_R)
 
-        self.client.set_values_in_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_W,
-            spreadsheet_id=self.spreadsheet_id,
-            values=truncate_values(values, EXPORT_HEADER),
+        return self.mirror.get_projected_values(
+            projection, EXPORT_SHEET_NAME, EXPORT_FIRST_ROW
         )
 
-    def sync_data(self, agents, permitlist=None, onwards_andrew_id=None):
-        # Get list of variables
-        variables = self.client.get_values_from_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_HEADER, spreadsheet_id=self.spreadsheet_id
-        )[0]
-
+    def update_views(
+        self, views, agents, permitlist=None, onwards_andrew_id=None, resume=False
+    ):
         # Get list of students in export sheet
-        values = self.client.get_values_from_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_R, spreadsheet_id=self.spreadsheet_id
+        values = self.get_export_values()
+
+        checkpoint, options, done = self.__start_checkpoint(
+            "update_views",
+            values,
+            {
+                "views": views,
+                "permitlist": permitlist,
+                "onwards_andrew_id": onwards_andrew_id,
+            },
+            resume,
         )
+        views = options["views"]
+        permitlist = options["permitlist"]
+        onwards_andrew_id = options["onwards_andrew_id"]
 
-        onwards_flag = onwards_andrew_id is None
+        try:
+            for i, record, andrew_id in self.select_students(
+                values, permitlist, onwards_andrew_id, done
+            ):
+                # Update student card view
+                if "student" in agents:
+                    print(f"[INFO] Updating student view for {andrew_id}")
+                    ssid = get_entry(record, "ssid", EXPORT_SCHEMA)
+                    self.client.copy_sheets_to_spreadsheet(
+                        BASE_STUDENT_SPREADSHEET_ID, views, ssid, views
+                    )
 
-        for record in values:
-            andrew_id = get_entry(record, "andrew_id", EXPORT_HEADER)
-            onwards_flag = onwards_flag or andrew_id == onwards_andrew_id
-            if permitlist is not None and andrew_id not in permitlist:
-                continue
-            if not onwards_flag:
-                continue
+                # Update TA card view
+                if "ta" in agents:
+                    print(f"[INFO] Updating TA view for {andrew_id}")
+                    _ssid = get_entry(record, "_ssid", EXPORT_SCHEMA)
+                    self.client.copy_sheets_to_spreadsheet(
+                        BASE_STUDENT_SPREADSHEET_ID, views, _ssid, views
+                    )
 
-            # Sync student card data
-            if "student" in agents:
-                print(f"[INFO] Syncing student data for {andrew_id}")
+                checkpoint.done(i)
+        finally:
+            checkpoint.flush()
+            self.client.card_layouts.save()
 
-                public_variables = []
-                for variable in variables:
-                    if variable == "STOP":
-                        # Stop syncing variables after this point
-                        break
-                    if variable[0] != "_":
-                        public_variables.append(variable)
+        checkpoint.journal.finish()
 
-                entries = get_entries_across(record, public_variables, variables)
-                data = list(zip(public_variables, entries))
+    def sync_data(
+        self,
+        agents,
+        permitlist=None,
+        onwards_andrew_id=None,
+        incremental=True,
+        resume=False,
+        journal_name="sync_data",
+    ):
+        variables, public_projection, projection = self.get_card_variables(agents)
 
-                ssid = get_entry(record, "ssid", EXPORT_HEADER)
-                while True:
-                    try:
-                        self.client.set_values_in_sheet(
-                            sheet_range=DATA_SHEET_NAME,
-                            spreadsheet_id=ssid,
-                            values=data,
-                            clear_range=True,
-                        )
-                        break
-                    except HttpError:
-                        print("[ERROR] Caught HttpError (likely rate-limit), waiting for 10s")
-                        sleep(10)
-
-            # Sync TA card data
-            if "ta" in agents:
-                print(f"[INFO] Syncing TA data for {andrew_id}")
-
-                data = list(zip(variables, record))
-
-                _ssid = get_entry(record, "_ssid", EXPORT_HEADER)
-                self.client.set_values_in_sheet(
-                    sheet_range=DATA_SHEET_NAME,
-                    spreadsheet_id=_ssid,
-                    values=data,
-                    clear_range=True,
+        # Get list of students in export sheet
+        values = self.get_export_values(projection)
+
+        checkpoint, options, done = self.__start_checkpoint(
+            journal_name,
+            values,
+            {"permitlist": permitlist, "onwards_andrew_id": onwards_andrew_id},
+            resume,
+        )
+        permitlist = options["permitlist"]
+        onwards_andrew_id = options["onwards_andrew_id"]
+
+        pending = []
+        report = {"written": 0, "skipped": 0, "failed": 0}
+
+        try:
+            for i, record, andrew_id in self.select_students(
+                values, permitlist, onwards_andrew_id, done
+            ):
+                writes = self.get_card_writes(
+                    record, variables, public_projection, agents, incremental
                 )
+                if not writes:
+                    report["skipped"] += 1
+                    continue
 
-            set_entry(record, now(), "last_updated", EXPORT_HEADER)
+                print(f"[INFO] Syncing card data for {andrew_id}")
+                pending.append((i, record, writes))
 
-        self.client.set_values_in_sheet(
-            sheet_range=EXPORT_SHEET_RANGE_W,
-            spreadsheet_id=self.spreadsheet_id,
-            values=truncate_values(values, EXPORT_HEADER),
+                if len(pending) >= SYNC_BATCH_SIZE:
+                    self.__flush_card_data(pending, report, checkpoint)
+                    pending = []
+
+            if pending:
+                self.__flush_card_data(pending, report, checkpoint)
+        finally:
+            checkpoint.flush()
+            self.fingerprints.save()
+
+        checkpoint.journal.finish()
+
+        print(
+            f"[INFO] Synced {report['written']} students, skipped "
+            f"{report['skipped']} unchanged, {report['failed']} failed"
         )
 
-    def load_gradescope_data(self, data, sheet_name):
-        print("[INFO] Uploading data to Gradecard")
-        sheets = self.client.get_sheets_from_spreadsheet(self.spreadsheet_id)
+    def get_card_variables(self, agents):
+        # Get list of variables
+        variables = Schema(self.mirror.get_values(EXPORT_SHEET_RANGE_HEADER)[0])
+
+        # Plan which variables students see once, rather than per student
+        public_variables = []
+        for variable in variables:
+            if variable == "STOP":
+                # Stop syncing variables after this point
+                break
+            if variable and variable[0] != "_":
+                public_variables.append(variable)
+
+        # TA cards hold every variable, so only student cards can skip columns
+        if "ta" in agents:
+            return variables, variables.project(public_variables), None
+
+        # Student cards read compact rows of the kept and public columns
+        columns = list(EXPORT_HEADER)
+        columns.extend(
+            variable for variable in public_variables if variable not in columns
+        )
+        projection = variables.project(columns)
+        variables = Schema(columns)
+        return variables, variables.project(public_variables), projection
+
+    def get_card_writes(
+        self, record, variables, public_projection, agents, incremental=True
+    ):
+        # Map each of a student's cards to the data it should hold
+        writes = {}
+
+        # Sync student card data
+        if "student" in agents:
+            data = public_projection.pairs(record)
+
+            ssid = get_entry(record, "ssid", EXPORT_SCHEMA)
+            writes[ssid] = data
+
+        # Sync TA card data
+        if "ta" in agents:
+            data = list(zip(variables, record))
+
+            _ssid = get_entry(record, "_ssid", EXPORT_SCHEMA)
+            writes[_ssid] = data
+
+        # Skip cards whose data has not changed since they were last written
+        if incremental:
+            writes = {
+                ssid: data
+                for ssid, data in writes.items()
+                if self.fingerprints.get(ssid) != self.__fingerprint_card(data)
+            }
 
-        if sheet_name not in sheets:
-            self.client.create_sheet_in_spreadsheet(self.spreadsheet_id, sheet_name)
-        else:
-            self.client.set_values_in_sheet(
-                f"{sheet_name}!A1:NP", self.spreadsheet_id, [[]], clear_range=True
-            )
+        return writes
 
-        self.client.set_values_in_sheet(
-            f"{sheet_name}!A1", self.spreadsheet_id, data, clear_range=True
+    def __fingerprint_card(self, data):
+        # last_updated changes on every sync, so it must not count as a change
+        return fingerprint([entry for entry in data if entry[0] != "last_updated"])
+
+    def __flush_card_data(self, pending, report, checkpoint):
+        print(f"[INFO] Sending data for {len(pending)} students in batches")
+        values_by_spreadsheet_id = {}
+        for _, _, writes in pending:
+            values_by_spreadsheet_id.update(writes)
+
+        failed = self.client.batch_set_values_in_sheets(
+            sheet_range=DATA_SHEET_NAME,
+            values_by_spreadsheet_id=values_by_spreadsheet_id,
+            clear_range=True,
         )
 
+        for ssid, data in values_by_spreadsheet_id.items():
+            if ssid not in failed:
+                self.fingerprints.set(ssid, self.__fingerprint_card(data))
+        self.fingerprints.save(force=False)
+
+        for i, record, writes in pending:
+            errors = [failed[ssid] for ssid in writes if ssid in failed]
+            if errors:
+                andrew_id = get_entry(record, "andrew_id", EXPORT_SCHEMA)
+                print(f"[ERROR] Syncing data failed for {andrew_id}: {errors[0]}")
+                report["failed"] += 1
+                continue
+
+            checkpoint.done(i)
+            report["written"] += 1
+
+    def load_gradescope_data(self, data, sheet_name):
+        print("[INFO] Uploading data to Gradecard")
+        self.client.replace_sheet_values(self.spreadsheet_id, sheet_name, data)
+        self.mirror.commit()
+
 
 class GradescopeService:
     def __init__(self):
         self.client = GradescopeClient()
         self.gcp_service = GoogleCloudService()
+        self.catalog = ConfigCatalog()
 
     def get_configs(self):
-        # Fetch list of config files
-        try:
-            config_files = [i for i in os.listdir(CONFIG_PATH) if i.endswith(".ini")]
-        except FileNotFoundError:
-            return []
-
-        # Get names for config files
-        configs = []
-        for config_file in config_files:
-            config = configparser.ConfigParser()
-            config.read(os.path.join(CONFIG_PATH, config_file))
-            try:
-                name = config["overview"]["name"]
-            except KeyError:
-                continue
-
-            configs.append({"name": name, "value": config_file})
-
-        # Sort configs
-        configs.sort(
-            key=lambda config: map(
-                lambda s: int(s) if s.isdigit() else s, config["name"].split(" ")
-            )
-        )
-
-        return configs
+        return self.catalog.get_configs()
 
     def read_config(self, config):
-        # Load config file
-        config_dict = configparser.ConfigParser()
-        config_dict.read(os.path.join(CONFIG_PATH, config))
+        # Configs are parsed and compiled once per change to the file
+        return self.catalog.get_plan(config)
 
-        try:
-            # Read initial name info
-            config_data = {
-                "name": config_dict["overview"]["name"],
-                "cyu": config_dict["overview"]["cyu"],
-                "num_questions": config_dict.getint(
-                    "overview", "num_questions", fallback=0
-                ),
-                "gsheet_name": config_dict["overview"]["gsheet_name"],
-                "questions": [],
-            }
+    def clear_cache(self, configs=None):
+        if configs is None:
+            print("[INFO] Clearing all cached Gradescope data")
+            self.client.clear_cache()
+            return
 
-            # Read question data
-            questions = [
-                f"question{i}" for i in range(1, 1 + config_data["num_questions"])
-            ]
-            for question in questions:
-                if question in config_dict:
-                    config_data["questions"].append(
-                        {
-                            "name": config_dict[question]["name"],
-                            "star_name": config_dict[question].get("star_name", None),
-                        }
-                    )
-                else:
-                    config_data["questions"].append(None)
-        except KeyError:
-            raise ValueError("Malformed Configuration")
+        assignment_names = []
+        for config in configs:
+            try:
+                config_data = self.read_config(config)
+            except ValueError:
+                print(f"[ERROR] {config} is malformed")
+                continue
 
-        return config_data
+            print(f"[INFO] Clearing cached Gradescope data for {config}")
+            assignment_names.append(config_data.name)
+            if config_data.cyu:
+                assignment_names.append(config_data.cyu)
 
-    def load_data_from_config(self, config):
+        self.client.clear_cache(assignment_names)
+
+    def prepare_config(self, config):
+        # Read the config and resolve its assignments up front, since this may
+        # prompt about unpublished assignments
         try:
             config_data = self.read_config(config)
         except ValueError:
             print(f"[ERROR] {config} is malformed")
-            return
+            return None
+
+        try:
+            assignment = self.get_assignment(config_data.name)
+        except KeyError:
+            assignment = None
+            print(f"[ERROR] Fetching data failed for {config}")
 
+        cyu_assignment = None
+        if config_data.cyu:
+            try:
+                cyu_assignment = self.get_assignment(config_data.cyu)
+            except KeyError:
+                print(f"[ERROR] Fetching CYU data failed for {config}")
+
+        return config, config_data, assignment, cyu_assignment
+
+    def fetch_config_data(self, config, config_data, assignment, cyu_assignment):
         # Fetch assignment data
         print(f"[INFO] Fetching data for {config}")
         try:
-            assignment_data = self.get_assignment_evaluations(config_data)
-        except KeyError as e:
+            assignment_data = self.get_assignment_evaluations(config_data, assignment)
+        except KeyError:
             assignment_data = {}
             print(f"[ERROR] Fetching data failed for {config}")
 
         # Fetch CYU data
-        if config_data["cyu"]:
+        cyu_data = {}
+        if cyu_assignment is not None:
             print(f"[INFO] Fetching CYU data for {config}")
-            try:
-                cyu_data = self.get_cyu_evaluations(config_data)
-            except KeyError:
-                cyu_data = {}
-                print(f"[ERROR] Fetching CYU data failed for {config}")
+            cyu_data = self.get_cyu_evaluations(cyu_assignment)
 
-        # Generate CSV file
-        print("[INFO] Generating CSV file")
-        data = self.combine_assignment_and_cyu_data(
+        return config_data, assignment_data, cyu_data
+
+    def transform_config_data(self, config_data, assignment_data, cyu_data):
+        # Rows are generated lazily, header first, in the upload column layout
+        print(f"[INFO] Generating data for {config_data.gsheet_name}")
+        rows = self.generate_upload_rows(
             assignment_data,
-            config_data["num_questions"],
+            config_data.num_questions,
             cyu_data,
         )
 
-        # Convert CSV to text
-        with io.StringIO() as csvfile:
-            fieldnames = ["Andrew ID", "Submission Time", "CYU Quiz Score"]
-            question_fieldnames = [
-                [
-                    f"Problem {i} Score",
-                    f"Problem {i} TA",
-                    f"Problem {i} Name",
-                    f"Problem {i} ⭐",
-                    f"Problem {i} Comments",
-                ]
-                for i in range(1, 1 + config_data["num_questions"])
-            ]
-            for question in question_fieldnames:
-                fieldnames.extend(question)
-
-            csvwriter = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            csvwriter.writeheader()
-            for line in data:
-                csvwriter.writerow(line)
+        return (
+            itertools.chain([list(config_data.columns)], rows),
+            config_data.gsheet_name,
+        )
 
-            csvfile.seek(0)
+    def load_data_from_config(self, config):
+        job = self.prepare_config(config)
+        if job is None:
+            return
 
-            csvreader = csv.reader(csvfile)
-            data = [line for line in csvreader]
+        data, sheet_name = self.transform_config_data(*self.fetch_config_data(*job))
 
         # Upload data
-        self.gcp_service.load_gradescope_data(data, config_data["gsheet_name"])
-
-    def get_question_names_for_question(self, question, all_question_names):
-        data = []
-
-        for q in all_question_names:
+        self.gcp_service.load_gradescope_data(data, sheet_name)
+
+    def load_data_from_configs(self, configs, workers=GRADESCOPE_FETCH_WORKERS):
+        # Fetch, transform and upload in separate stages joined by bounded
+        # queues, so that network waits for different configs overlap
+        jobs = [job for job in map(self.prepare_config, configs) if job is not None]
+        fetched = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        transformed = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        # Set when the load is interrupted, after which the stages only drain
+        # their queues until the end of the pipeline reaches them
+        stopping = threading.Event()
+        errors = []
+
+        def fetch(job):
+            if stopping.is_set():
+                return
             try:
-                colon = q.index(":")
-                paren = q.index("(")
-            except ValueError:
-                continue
-
-            if q[colon + 1 : paren].strip().startswith(question):
-                data.append(q)
-
-        if len(data) == 0:
-            raise KeyError("No Matching Question Found")
-
-        return data
-
-    def get_question_data_for_question(self, question_names, q_evaluation):  # TODO
-        tas = ";".join(
-            self.get_question_tas_for_question(q_evaluation[q])
-            for q in question_names
-            if self.get_question_tas_for_question(q_evaluation[q]) is not None
-        )
-
-        return {
-            "score": sum(
-                round_to_hundredths(q_evaluation[q]["score"]) for q in question_names
-            ),
-            "TA": tas,
-            "comments": ";".join(q_evaluation[q]["comment"] for q in question_names),
-        }
+                fetched.put(self.fetch_config_data(*job))
+            except Exception as e:
+                print(f"[ERROR] Fetching data failed for {job[0]}: {e}")
 
-    def get_question_tas_for_question(self, q_evaluation):  # TODO
-        for key, value in q_evaluation["rubric_items"].items():
-            if key.startswith("Grader") and value:
-                try:
-                    paren = key.index("(")
-                except ValueError:
+        def transform():
+            try:
+                while (item := fetched.get()) is not None:
+                    if stopping.is_set():
+                        continue
+                    try:
+                        data, sheet_name = self.transform_config_data(*item)
+                        transformed.put((list(data), sheet_name))
+                    except Exception as e:
+                        print(f"[ERROR] Generating data failed: {e}")
+            finally:
+                transformed.put(None)
+
+        def upload():
+            while (item := transformed.get()) is not None:
+                if stopping.is_set():
                     continue
+                try:
+                    self.gcp_service.load_gradescope_data(*item)
+                except Exception as e:
+                    print(f"[ERROR] Uploading data failed for {item[1]}: {e}")
 
-                return key[paren + 1 : paren + 3]
-
-        return None
-
-    def get_assignment_evaluations(self, config_data):
-        assignment = self.client.get_assignment_by_name(config_data["name"])
+        def run_stage(stage, inbox):
+            try:
+                stage()
+            except BaseException as e:
+                errors.append(e)
+                stopping.set()
+                # Keep draining, so that no earlier stage blocks on a full queue
+                while inbox.get() is not None:
+                    pass
+
+        stages = [
+            threading.Thread(target=run_stage, args=(transform, fetched)),
+            threading.Thread(target=run_stage, args=(upload, transformed)),
+        ]
+        for stage in stages:
+            stage.start()
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        try:
+            futures.extend(executor.submit(fetch, job) for job in jobs)
+            for future in futures:
+                future.result()
+        except BaseException:
+            stopping.set()
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # The end of the pipeline must always reach the stages, or they
+            # wait for it forever
+            executor.shutdown()
+            fetched.put(None)
+            for stage in stages:
+                stage.join()
+
+        if errors:
+            raise errors[0]
+
+    def get_assignment(self, assignment_name):
+        assignment = self.client.get_assignment_by_name(assignment_name)
 
         if not assignment["published"]:
             if not prompt_confirm_unpublished(assignment["name"]):
                 print(f"[INFO] Skipping {assignment['name']}")
-                return {}
+                return None
+
+        return assignment
+
+    def get_assignment_evaluations(self, config_data, assignment):
+        if assignment is None:
+            return {}
 
         evaluation_data = self.client.get_evaluation_data_by_assignment_id(
             assignment["id"]
         )
-        if len(evaluation_data) == 0:
+        sample_evaluation = next(evaluation_data, None)
+        if sample_evaluation is None:
             return {}
 
-        all_questions = []
-        for q in range(config_data["num_questions"]):
-            if config_data["questions"][q] is None:
-                continue
-
-            all_questions.append(config_data["questions"][q]["name"])
-            if config_data["questions"][q]["star_name"]:
-                all_questions.append(config_data["questions"][q]["star_name"])
+        from scoring import ScoringPlan  # imports NumPy
 
-        # Get map of question from config to question name(s) on Gradescope
-        all_question_data = list(evaluation_data[0]["questions"].keys())
-        map_question_to_question_names = {
-            q: self.get_question_names_for_question(q, all_question_data)
-            for q in all_questions
-        }
-
-        evaluations = {}
-
-        for evaluation in evaluation_data:
-            if evaluation["Status"] != "Graded":
-                continue
-
-            current_evaluation = {
-                "Submission Time": evaluation["Submission Time"],
-                "questions": [],
-            }
-
-            # Read each question
-            for q in range(config_data["num_questions"]):
-                q_config = config_data["questions"][q]
-                if q_config is None:
-                    current_evaluation["questions"].append(None)
-                    continue
-
-                star = False
-                data = self.get_question_data_for_question(
-                    map_question_to_question_names[q_config["name"]],
-                    evaluation["questions"],
-                )
-
-                if data["score"] < STAR_THRESHOLD and q_config["star_name"]:
-                    star_data = self.get_question_data_for_question(
-                        map_question_to_question_names[q_config["star_name"]],
-                        evaluation["questions"],
-                    )
+        # Compile the config against this assignment's questions once, then
+        # score every submission together as they stream from the cache
+        plan = ScoringPlan(config_data, sample_evaluation)
+        return plan.score(itertools.chain([sample_evaluation], evaluation_data))
 
-                    # Take star marked question
-                    if star_data["score"] >= STAR_THRESHOLD:
-                        star = True
-                        data = star_data
-
-                current_evaluation["questions"].append(data)
-                current_evaluation["questions"][q]["name"] = (
-                    q_config["star_name"] if star else q_config["name"]
-                )
-                current_evaluation["questions"][q]["star"] = star
-
-            evaluations[evaluation["Email"]] = current_evaluation
-
-        return evaluations
-
-    def get_cyu_evaluations(self, config_data):
-        assignment = self.client.get_assignment_by_name(config_data["cyu"])
-
-        if not assignment["published"]:
-            if not prompt_confirm_unpublished(assignment["name"]):
-                print(f"[INFO] Skipping {assignment['name']}")
-                return {}
+    def get_cyu_evaluations(self, assignment):
+        if assignment is None:
+            return {}
 
         evaluation_data = self.client.get_evaluation_data_by_assignment_id(
             assignment["id"]
@@ -565,32 +909,30 @@ class GradescopeService:
             if evaluation["Status"] == "Graded"
         }
 
-    def combine_assignment_and_cyu_data(self, assignment_data, num_questions, cyu_data):
+    def generate_upload_rows(self, assignment_data, num_questions, cyu_data):
         # Find all submissions
         all_emails = set(assignment_data) | set(cyu_data)
-        data = []
+        empty_question = ["", "", "", "", ""]
 
         for email in all_emails:
-            current = {"Andrew ID": email.split("@")[0]}
+            row = [email.split("@")[0], "", format_cell(cyu_data.get(email))]
 
             if email in assignment_data:
                 evaluation = assignment_data[email]
-                current["Submission Time"] = evaluation["Submission Time"]
+                row[1] = format_cell(evaluation["Submission Time"])
 
                 for q in range(num_questions):
                     current_q = evaluation["questions"][q]
                     if current_q is None:
+                        row.extend(empty_question)
                         continue
 
-                    current[f"Problem {q+1} Score"] = current_q["score"]
-                    current[f"Problem {q+1} TA"] = current_q["TA"]
-                    current[f"Problem {q+1} Name"] = current_q["name"]
-                    current[f"Problem {q+1} ⭐"] = current_q["star"]
-                    current[f"Problem {q+1} Comments"] = current_q["comments"]
-
-            if email in cyu_data:
-                current["CYU Quiz Score"] = cyu_data[email]
-
-            data.append(current)
+                    row.append(format_cell(current_q["score"]))
+                    row.append(format_cell(current_q["TA"]))
+                    row.append(format_cell(current_q["name"]))
+                    row.append(format_cell(current_q["star"]))
+                    row.append(format_cell(current_q["comments"]))
+            else:
+                row.extend(empty_question * num_questions)
 
-        return data
+            yield row
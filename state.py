@@ -0,0 +1,147 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+from constants import STATE_PATH, STATE_SAVE_INTERVAL
+
+# Marks keys deleted since the last save
+DELETED = object()
+
+
+class StateStore:
+    # Other processes (e.g. main.py next to the daemon) may save the same
+    # store, so only the keys changed here are merged into the file on save
+    def __init__(self, name):
+        self.path = os.path.join(STATE_PATH, f"{name}.json")
+        self.lock = threading.Lock()
+        self.saved = time.monotonic()
+        self.data = self.__read()
+        self.changes = {}
+
+    def __read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.changes[key] = value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+            self.changes[key] = DELETED
+
+    def save(self, force=True):
+        # Unforced saves are throttled, since the whole store is rewritten
+        if not force and time.monotonic() - self.saved < STATE_SAVE_INTERVAL:
+            return
+
+        # Write to a temporary file first so a crash never leaves a torn file,
+        # holding a lock file so no other process saves in between
+        os.makedirs(STATE_PATH, exist_ok=True)
+        with self.lock, open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = self.__read()
+            for key, value in self.changes.items():
+                if value is DELETED:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+
+            with open(f"{self.path}.tmp", "w") as f:
+                f.write(json.dumps(data))
+            os.replace(f"{self.path}.tmp", self.path)
+            self.data = data
+            self.changes = {}
+            self.saved = time.monotonic()
+
+
+class Journal:
+    # Append-only log of the students a run has finished. A run that never
+    # reached its finish entry was interrupted and can be resumed
+    def __init__(self, name):
+        self.path = os.path.join(STATE_PATH, "journal", f"{name}.jsonl")
+        self.lock = threading.Lock()
+        self.file = None
+
+    def read(self):
+        # Return the options and finished students of an interrupted run
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+
+        options = None
+        done = {}
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn by a crash mid-write
+
+            if entry["event"] == "start" and options is None:
+                options = entry["options"]
+            elif entry["event"] == "done":
+                done[entry["key"]] = entry["value"]
+            elif entry["event"] == "finish":
+                return None
+
+        if options is None:
+            return None
+        return options, done
+
+    def start(self, options, resume=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "a" if resume else "w")
+        if self.file.tell() > 0:
+            # Never append to a line left unterminated by a crash
+            self.file.write("\n")
+        self.__append({"event": "start", "time": time.time(), "options": options})
+
+    def done(self, key, value=None):
+        self.__append({"event": "done", "key": key, "value": value})
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+    def finish(self):
+        self.__append({"event": "finish", "time": time.time()})
+        self.sync()
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_state_store(name):
+    # One store per name for the whole process, so that clients on different
+    # threads never overwrite each other's changes
+    with stores_lock:
+        if name not in stores:
+            stores[name] = StateStore(name)
+        return stores[name]
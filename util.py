@@ -1,13 +1,95 @@
 from datetime import datetime as dt
+import hashlib
+import itertools
+import json
+import re
 import time
 
 
+class Schema:
+    # Header with a precomputed column name -> index map. Stands in for the
+    # plain header lists accepted by the helpers below
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.indices = {}
+        for i, column in enumerate(self.columns):
+            self.indices.setdefault(column, i)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __contains__(self, column):
+        return column in self.indices
+
+    def index(self, column):
+        try:
+            return self.indices[column]
+        except KeyError:
+            raise ValueError(f"{column!r} is not in schema") from None
+
+    def project(self, columns):
+        return Projection(self, columns)
+
+
+class Projection:
+    # Fixed selection of (name, index) pairs, built once and applied per record
+    __slots__ = ("columns", "indices")
+
+    def __init__(self, schema, columns):
+        self.columns = list(columns)
+        self.indices = [schema.index(column) for column in self.columns]
+
+    def pairs(self, record):
+        return [
+            (column, record[i])
+            for column, i in zip(self.columns, self.indices)
+            if i < len(record)
+        ]
+
+    def get_spans(self):
+        # Contiguous runs of the projected columns, as (first, last) indices
+        spans = []
+        for i in sorted(set(self.indices)):
+            if spans and spans[-1][1] == i - 1:
+                spans[-1][1] = i
+            else:
+                spans.append([i, i])
+        return spans
+
+    def get_ranges(self, sheet_name, first_row):
+        # Fewest ranges of the sheet that cover every projected column
+        return [
+            f"{sheet_name}!{get_column_letter(first)}{first_row}:"
+            f"{get_column_letter(last)}"
+            for first, last in self.get_spans()
+        ]
+
+    def join(self, values_by_range):
+        # Reassemble the rows read for each range of get_ranges into compact
+        # rows, one padded cell per projected column
+        spans = self.get_spans()
+        num_rows = max([0] + [len(values) for values in values_by_range])
+        rows = []
+        for r in range(num_rows):
+            cells = {}
+            for (first, _), values in zip(spans, values_by_range):
+                if r < len(values):
+                    for j, cell in enumerate(values[r]):
+                        cells[first + j] = cell
+            rows.append([cells.get(i, "") for i in self.indices])
+        return rows
+
+
 def get_entry(record, column_name, columns):
     i = columns.index(column_name)
     return record[i]
 
 
 def get_entries_across(record, column_names, columns):
+    column_names = set(column_names)
     result = []
     for value, column in zip(record, columns):
         if column in column_names:
@@ -42,9 +124,104 @@ def truncate_values(values, header):
     return [record[:max_length] for record in values]
 
 
+def get_column_letter(index):
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def get_column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def parse_range(sheet_range):
+    # Sheet name, then the zero based first row and column and last row and
+    # column of a range, with None for an open end
+    sheet, _, cells = sheet_range.partition("!")
+
+    def parse_cell(cell):
+        letters, digits = re.fullmatch(r"([A-Z]*)(\d*)", cell).groups()
+        row = int(digits) - 1 if digits else None
+        column = get_column_index(letters) if letters else None
+        return row, column
+
+    start, _, end = cells.partition(":")
+    first_row, first_column = parse_cell(start)
+    last_row, last_column = parse_cell(end) if end else (first_row, first_column)
+    if not cells:
+        last_row, last_column = None, None
+
+    return sheet, first_row or 0, first_column or 0, last_row, last_column
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def chunk_rows(rows, max_bytes):
+    # Group rows into chunks whose JSON payload stays under max_bytes
+    chunk = []
+    size = 0
+    for row in rows:
+        row_size = len(json.dumps(row, default=str)) + 1
+        if chunk and size + row_size > max_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(row)
+        size += row_size
+
+    if chunk:
+        yield chunk
+
+
+def get_extent(values):
+    return [len(values), max([0] + [len(row) for row in values])]
+
+
+def pad_values(values, num_rows, num_columns):
+    # Blank out every cell of a previously written area not covered by values
+    padded = [list(row) + [""] * (num_columns - len(row)) for row in values]
+    padded.extend([""] * num_columns for _ in range(num_rows - len(values)))
+    return padded
+
+
+def format_cell(value):
+    return "" if value is None else str(value)
+
+
+def get_cell(record, i):
+    # The Sheets API drops trailing empty cells from every row it returns
+    return record[i] if i < len(record) else ""
+
+
+def cells_equal(a, b):
+    # Sheets reformats numbers entered as text, e.g. "12.0" reads back as "12"
+    a, b = a.strip(), b.strip()
+    if a == b:
+        return True
+    try:
+        return float(a) == float(b)
+    except ValueError:
+        return False
+
+
 def now():
     return str(dt.now())
 
 
 def round_to_hundredths(num):
     return round(num * 100) / 100
+
+
+def fingerprint(values):
+    data = json.dumps(values, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()